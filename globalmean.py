@@ -1,17 +1,25 @@
 """A module to compute the seasonal mean over a variable in a dataset.
 
-Depends on IPython, netCDF4 and cdms2.
+Depends on IPython and nc_ipython (and so netCDF4).
 
-See the run function.  time_bounds may also be useful.
+See the run and run_iter functions.  time_bounds may also be useful.
 
 """
 
-from glob import glob
+from math import ceil
+from contextlib import closing
+from hashlib import sha1
 
-from IPython.parallel import Client, interactive
+from IPython.parallel import Client, interactive, Reference
 import numpy
-from netCDF4 import MFDataset, num2date
-import cdms2
+from nc_ipython.ncserialisable import Dataset, MFDataset, iter_variable_blocks
+from nc_ipython.aggregation import aggregation_index
+from nc_ipython.affinity import iter_affinity
+from nc_ipython.gridweights import area_weights
+from nc_ipython.checkpoint import CheckpointStore
+from nc_ipython.ncoutput import OutputFile
+from nc_ipython.session import Session
+from nc_ipython import resultcache
 
 
 def split_range (start, end, n_pieces):
@@ -41,99 +49,456 @@ time_name: the name of the time variable; can actually be any one-dimensional
 
 Times are netCDF4.netcdftime.datetime objects.  If length is 0, times are None.
 
+This uses nc_ipython.aggregation, so only opens files that have changed since
+it was last called.
+
+"""
+    return aggregation_index(files, time_name).time_bounds()
+
+
+def _weighted_percentiles (data, wt, percentiles):
+    # data: (n, m) with NaN where missing; wt: (m,) weights; returns
+    # (len(percentiles), n); each value is placed at the middle of its share
+    # of the total weight, and percentiles interpolated between these
+    result = numpy.empty((len(percentiles), len(data)))
+    qs = numpy.asarray(percentiles, float) / 100
+    for i, row in enumerate(data):
+        valid = ~numpy.isnan(row)
+        x = row[valid]
+        if not len(x):
+            result[:, i] = numpy.nan
+            continue
+        order = numpy.argsort(x)
+        w = wt[valid][order]
+        cw = numpy.cumsum(w)
+        total = cw[-1]
+        result[:, i] = numpy.interp(qs, (cw - .5 * w) / total, x[order])
+    return result
+
+
+def block_stats (data, wt, time_index, lat_index, lon_index,
+                 percentiles = ()):
+    """Compute partial area-weighted statistics for a block of data.
+
+block_stats(data, wt, time_index, lat_index, lon_index, percentiles = ())
+    -> partial
+
+data: the block of a variable (can be masked).  Masked values may be
+      overwritten, and integer data is converted to float.
+wt: latitude/longitude weights, with shape (lat, lon).
+time_index, lat_index, lon_index: the axes of data for these dimensions.
+percentiles: percentiles (0 to 100) to compute; these are weighted by area.
+
+partial: a dict of arrays, each with time along the first axis followed by any
+         other dimensions of data except lat and lon, in order:
+    weight: total weight of unmasked values.
+    sum, sumsq: weighted sum of values and of squared values.
+    min, max: minimum and maximum unmasked values (NaN if there are none).
+    and for each percentile q, 'p{q}' (see finish_stats).
+
+Weighted sums are computed with numpy.einsum (in double precision) over the
+data in place, and all statistics in one pass over the block, so no temporary
+arrays the size of the block are created, except for percentiles.
+
+See join_stats, merge_stats and finish_stats.
+
 """
-    with MFDataset(files) as d:
-        t = d.variables[time_name]
-        l = len(t)
-        if l == 0:
-            times = (None, None)
+    mask = numpy.ma.getmask(data)
+    x = numpy.ma.getdata(data)
+    if mask is not numpy.ma.nomask and not mask.any():
+        mask = numpy.ma.nomask
+    if x.dtype.kind != 'f':
+        x = x.astype(float)
+    elif mask is not numpy.ma.nomask and not x.flags.writeable:
+        x = x.copy()
+    # einsum subscripts: output has time first, then other axes in order
+    axes = 'abcdefghijklmnopqrstuvw'[:x.ndim]
+    wt_axes = axes[lat_index] + axes[lon_index]
+    out_axes = axes[time_index] + ''.join(
+        a for i, a in enumerate(axes)
+        if i not in (time_index, lat_index, lon_index)
+    )
+    # order to move the axes of fmin.reduce results to, to match
+    kept = [i for i in xrange(x.ndim) if i not in (lat_index, lon_index)]
+    kept_order = [kept.index(time_index)] + [
+        i for i, ax in enumerate(kept) if ax != time_index]
+
+    partial = {}
+    # statistics that ignore missing values given as NaN
+    if mask is not numpy.ma.nomask:
+        numpy.copyto(x, numpy.nan, where = mask)
+    for name, f in (('min', numpy.fmin), ('max', numpy.fmax)):
+        partial[name] = f.reduce(x, axis = (lat_index, lon_index)) \
+                         .transpose(kept_order).astype(float)
+    if percentiles:
+        moved = x.transpose([time_index] + [
+            i for i in xrange(x.ndim)
+            if i not in (time_index, lat_index, lon_index)
+        ] + [lat_index, lon_index])
+        shape = moved.shape[:-2]
+        p = _weighted_percentiles(moved.reshape(-1, wt.size), wt.ravel(),
+                                  percentiles)
+        for q, values in zip(percentiles, p):
+            partial['p{0:g}'.format(q)] = values.reshape(shape)
+    # weighted sums, which need missing values to be 0
+    if mask is not numpy.ma.nomask:
+        numpy.copyto(x, 0, where = mask)
+        masked_wt = numpy.einsum('{0},{1}->{2}'.format(axes, wt_axes,
+                                                       out_axes),
+                                 mask, wt, dtype = numpy.float64)
+        partial['weight'] = wt.sum() - masked_wt
+        # avoid rounding errors where everything is masked
+        partial['weight'][numpy.isnan(partial['min'])] = 0
+    else:
+        shape = partial['min'].shape
+        partial['weight'] = numpy.empty(shape)
+        partial['weight'].fill(wt.sum())
+    partial['sum'] = numpy.einsum(
+        '{0},{1}->{2}'.format(axes, wt_axes, out_axes),
+        x, wt, dtype = numpy.float64
+    )
+    partial['sumsq'] = numpy.einsum(
+        '{0},{0},{1}->{2}'.format(axes, wt_axes, out_axes),
+        x, x, wt, dtype = numpy.float64
+    )
+    return partial
+
+
+def join_stats (partials):
+    """Join partial statistics for consecutive ranges of times.
+
+join_stats(partials) -> partial
+
+partials: a non-empty list of results from block_stats, in time order.
+
+"""
+    return dict((k, numpy.concatenate([p[k] for p in partials]))
+                for k in partials[0])
+
+
+def merge_stats (partials):
+    """Merge partial statistics for different parts of the grid.
+
+merge_stats(partials) -> partial
+
+partials: a non-empty list of results from block_stats for the same times and
+          non-overlapping sets of lat/lon points.  Percentiles can't be merged
+          this way.
+
+This is exact: weights and sums are added, and minima and maxima combined.
+
+"""
+    result = {}
+    for k in partials[0]:
+        values = [p[k] for p in partials]
+        if k in ('weight', 'sum', 'sumsq'):
+            result[k] = sum(values[1:], values[0])
+        elif k == 'min':
+            result[k] = reduce(numpy.fmin, values)
+        elif k == 'max':
+            result[k] = reduce(numpy.fmax, values)
         else:
-            times = tuple(num2date((t[0], t[-1]), t.units, t.calendar))
-    return times + (l,)
+            raise ValueError('can\'t merge percentiles')
+    return result
 
 
-def get_mean_serial (files, start, end, var_names, times_at_once, wt):
-    """Compute the global mean.
+def finish_stats (partial, stats = ('mean',)):
+    """Compute statistics from partial statistics.
 
-get_mean_serial(files, start, end, var_names, wt) -> results
+finish_stats(partial, stats = ('mean',)) -> results
 
-files: as taken by netCDF4.MFDataset.
-start, end: as taken by run.
-var_names: (time, lat, lon, var) variable names.
-wt: latitude/longitude weights for var.
+partial: as returned by block_stats, join_stats or merge_stats.
+stats: names of statistics to compute:
+    mean: area-weighted mean of unmasked values.
+    var, std: area-weighted variance and standard deviation.
+    min, max: minimum and maximum.
+    p{q}: the area-weighted q-th percentile, where q is given in the
+          percentiles argument to block_stats, eg. 'p50' for the median.
+
+results: dict of arrays with the names in stats as keys.  Values for times
+         with no unmasked data are NaN.
 
-results: the var array along time with each subarray its mean.
+"""
+    results = {}
+    with numpy.errstate(invalid = 'ignore', divide = 'ignore'):
+        mean = partial['sum'] / partial['weight']
+        var = None
+        for name in stats:
+            if name == 'mean':
+                results[name] = mean
+            elif name in ('var', 'std'):
+                if var is None:
+                    var = partial['sumsq'] / partial['weight'] - mean * mean
+                    var = numpy.maximum(var, 0)
+                results[name] = var if name == 'var' else numpy.sqrt(var)
+            elif name.startswith('p'):
+                # block_stats keys percentiles by q formatted with 'g', so
+                # eg. 'p50.0' finds 'p50'
+                results[name] = partial['p{0:g}'.format(float(name[1:]))]
+            else:
+                results[name] = partial[name]
+    return results
+
+
+def _percentiles (stats):
+    # percentiles needed by block_stats for the given statistics
+    return [float(name[1:]) for name in stats if name.startswith('p')]
+
+
+def iter_mean_serial (files, start, end, var_names, times_at_once, wt,
+                      prefetch = 2, percentiles = ()):
+    """Compute partial global statistics, a block at a time.
+
+iter_mean_serial(files, start, end, var_names, times_at_once, wt,
+                 prefetch = 2, percentiles = ()) -> iterator
+
+Takes the same arguments as get_mean_serial, and yields (times, partial) as
+returned by that function for each block of at most times_at_once times, in
+order.
 
 """
-    with MFDataset(files) as d:
+    var_name = var_names[3]
+    names = [var_name] if isinstance(var_name, basestring) else var_name
+    d = files if isinstance(files, Dataset) else MFDataset(files)
+    with d:
         # get variables
-        time, lat, lon, var = [d.variables[name] for name in var_names]
-        # create slice
-        time_index, lat_index, lon_index = [
-            var.dimensions.index(v.dimensions[0])
-            for v in (time, lat, lon)
-        ]
-        index = [0] * len(var.dimensions)
-        index[lat_index] = slice(None)
-        index[lon_index] = slice(None)
-        data = []
-        # read times
+        time, lat, lon = [d.variables[name] for name in var_names[:3]]
+        variables = [d.variables[name] for name in names]
+        indices = [[var.dimensions.index(v.dimensions[0])
+                    for v in (time, lat, lon)]
+                   for var in variables]
+        # read times first: the file can't be read from while blocks are
+        # being read in the background
         time = time[start:end]
-        # do in time chunks
-        n = end - start
-        n_pieces = n / times_at_once + bool(n % times_at_once)
-        times = split_range(start, end, n_pieces)
-        for start, end in times:
-            index[time_index] = slice(start, end)
-            # get and transform data
-            this_data = var[index] * wt
-            # sum over data: get new indices: should be 3D, in the same order
-            indices = [ident for i, ident in
-                       sorted(((time_index, 'time'), (lat_index, 'lat'),
-                               (lon_index, 'lon')))]
-            for name in ('lat', 'lon'):
-                i = indices.index(name)
-                this_data = this_data.sum(i)
-                indices.pop(i)
-            data.append(this_data)
-    return (time, numpy.hstack(data))
-
-
-def get_mean_parallel (dv, files, start, end, var_names, times_at_once, wt):
-    """Compute the seasonal mean in parallel.
-
-get_mean_serial(dv, files, start, end, var_names, wt) -> results
+        # do in time chunks, reading the next while working on this one; all
+        # variables are read for each chunk
+        blocks = iter_variable_blocks(variables, times_at_once,
+                                      [i[0] for i in indices], start, end,
+                                      None, prefetch)
+        # stop reading before the file is closed, if we stop early
+        with closing(blocks):
+            for t0, t1, data in blocks:
+                partials = dict(
+                    (name, block_stats(this_data, wt, *index,
+                                       percentiles = percentiles))
+                    for name, this_data, index in zip(names, data, indices)
+                )
+                yield (time[t0 - start:t1 - start],
+                       partials if names is var_name else partials[var_name])
+
+
+def get_mean_serial (files, start, end, var_names, times_at_once, wt,
+                     prefetch = 2, percentiles = ()):
+    """Compute partial global statistics.
+
+get_mean_serial(files, start, end, var_names, times_at_once, wt,
+                prefetch = 2, percentiles = ()) -> (times, partial)
+
+files: as taken by netCDF4.MFDataset, or an ncserialisable Dataset or
+       MFDataset instance, which is closed afterwards.
+start, end: as taken by run.
+var_names: (time, lat, lon, var) variable names, where var may be a list of
+           names of variables on the same grid to compute statistics for
+           together.
+times_at_once: as taken by run.
+wt: latitude/longitude weights for var.
+prefetch: as taken by run.
+percentiles: as taken by block_stats.
+
+times: the values of the time variable in the range.
+partial: as returned by block_stats, for the whole range; see finish_stats.  If
+         var is a list, this is a dict of such results for each variable.
+
+"""
+    times, data = zip(*iter_mean_serial(files, start, end, var_names,
+                                        times_at_once, wt, prefetch,
+                                        percentiles))
+    return (numpy.hstack(times), _join(data, var_names[3]))
+
+
+def get_mean_files (parts, var_names, times_at_once, wt, prefetch = 2,
+                    percentiles = ()):
+    """Compute partial global statistics, opening files individually.
+
+get_mean_files(parts, var_names, times_at_once, wt, prefetch = 2,
+               percentiles = ()) -> (times, partial)
+
+parts: the ranges to compute over, as returned by
+       nc_ipython.aggregation.AggregationIndex.file_ranges.
+
+Other arguments and the return value are as for get_mean_serial.
+
+Unlike get_mean_serial with an MFDataset, this only opens the files it reads.
+Files are opened with ncserialisable.Dataset.deferred, so they stay open
+between calls (see ncserialisable.set_pool_size).
+
+"""
+    times = []
+    data = []
+    for path, start, end, offset in parts:
+        t, p = get_mean_serial(Dataset.deferred(path), start, end, var_names,
+                               times_at_once, wt, prefetch, percentiles)
+        times.append(t)
+        data.append(p)
+    return (numpy.hstack(times), _join(data, var_names[3]))
+
+
+def _push_functions (dv):
+    # send the functions get_mean_serial needs to engines
+    dv.execute('import numpy')
+    dv.execute('from contextlib import closing')
+    dv.execute('from nc_ipython.ncserialisable import Dataset, MFDataset')
+    dv.push({'get_mean_serial': get_mean_serial,
+             'get_mean_files': get_mean_files,
+             'iter_mean_serial': iter_mean_serial, 'block_stats': block_stats,
+             'join_stats': join_stats, '_join': _join,
+             '_weighted_percentiles': _weighted_percentiles,
+             'iter_variable_blocks': iter_variable_blocks})
+
+
+def get_mean_parallel (dv, files, start, end, var_names, times_at_once, wt,
+                       pieces = None, prefetch = 2, percentiles = ()):
+    """Compute partial global statistics in parallel.
+
+get_mean_parallel(dv, files, start, end, var_names, times_at_once, wt,
+                  pieces = None, prefetch = 2, percentiles = ())
+    -> (times, partial)
 
 dv: IPython DirectView to use.
 files: as taken by netCDF4.MFDataset.
 start, end: as taken by run.
-var_names: (time, lat, lon, var) variable names.
+var_names: as taken by get_mean_serial.
+times_at_once: as taken by run.
 wt: latitude/longitude weights for var.
+pieces: a list of (start, end) ranges to split the work into, one per engine,
+        covering start to end.  The default is to split into equal pieces; run
+        passes ranges from the partition method of the files'
+        nc_ipython.aggregation.AggregationIndex instead, which suit the
+        storage without opening the files.
+prefetch: as taken by run.
+percentiles: as taken by block_stats.
+
+times, partial: as returned by get_mean_serial.
 
-results: the var array along time with each subarray its mean.
+Each engine opens only the files its piece covers (see get_mean_files).
 
 """
     # split between engines
-    times = split_range(start, end, len(dv.targets))
-    dv.push({'get_mean_serial': get_mean_serial, 'split_range': split_range})
-    args = [(files, start, end, var_names, times_at_once, wt)
-            for start, end in times]
-    times, data = zip(*dv.map(lambda args: get_mean_serial(*args), args))
+    if pieces is None:
+        pieces = split_range(start, end, len(dv.targets))
+    _push_functions(dv)
+    index = aggregation_index(files, var_names[0])
+    args = [(index.file_ranges(start, end), var_names, times_at_once, wt,
+             prefetch, percentiles)
+            for start, end in pieces]
+    times, data = zip(*dv.map(lambda args: get_mean_files(*args), args))
     # join results
-    return (numpy.hstack(times), numpy.hstack(data))
+    return (numpy.hstack(times), _join(data, var_names[3]))
+
+
+def _chunks (index, start, end, var_names, times_at_once):
+    # split a range into storage-aligned chunks of around times_at_once times
+    # within each file, each given as parts taken by get_mean_files; the
+    # chunks of a file don't depend on other files
+    chunk_size = _chunk_size(index, var_names[3], var_names[0])
+    chunks = []
+    for path, f0, f1, offset in index.file_ranges(start, end):
+        n_chunks = int(ceil(float(f1 - f0) / times_at_once))
+        for t0, t1 in index.partition(n_chunks, offset + f0, offset + f1,
+                                      chunk_size):
+            chunks.append([(path, t0 - offset, t1 - offset, offset)])
+    return chunks
+
+
+def _iter_balanced (c, dv, chunks, var_names, times_at_once, wt, prefetch,
+                    percentiles, max_pending = None, retries = 0):
+    # compute partial statistics for chunks (from _chunks), handing them to
+    # engines as they become free, and yielding (times, partial) in order;
+    # chunks of a file go to engines that recently read that file where
+    # possible (see nc_ipython.affinity); at most max_pending chunks are
+    # started ahead of the earliest one not yet yielded; the weights pushed
+    # are deleted afterwards, unless dv is a Session
+    _push_functions(dv)
+    dv.push({'_globalmean_wt': wt})
+    try:
+        tasks = [(parts, var_names, times_at_once,
+                  Reference('_globalmean_wt'), prefetch, percentiles)
+                 for parts in chunks]
+        keys = [parts[0][0] for parts in chunks]
+        for result in iter_affinity(c, dv.targets, get_mean_files, tasks,
+                                    keys, max_pending, retries = retries):
+            yield result
+    finally:
+        if not isinstance(dv, Session):
+            # skip engines that died
+            targets = [t for t in dv.targets if t in c.ids]
+            if targets:
+                dv.execute('del _globalmean_wt', targets = targets)
+
+
+def _iter_checkpointed (c, dv, index, chunks, store, var_names, times_at_once,
+                        wt, prefetch, percentiles, max_pending = None,
+                        retries = 0):
+    # like _iter_balanced, but take results from a CheckpointStore where they
+    # were computed before, and store the rest as they arrive; runs serially
+    # if dv is None
+    stamps = dict(zip(index.files, index.stamps))
+    var_name = var_names[3]
+    if not isinstance(var_name, basestring):
+        var_name = tuple(var_name)
+    wt_hash = sha1(numpy.ascontiguousarray(wt, float).tostring()).hexdigest()
+    settings = (tuple(var_names[:3]) + (var_name,), tuple(percentiles),
+                wt_hash)
+    # a chunk is identified by its file (with its modification time and size)
+    # and range within it
+    keys = [('globalmean', parts[0][0], tuple(stamps[parts[0][0]]),
+             parts[0][1], parts[0][2]) + settings
+            for parts in chunks]
+    missing = [i for i, key in enumerate(keys) if key not in store]
+    missing_chunks = [chunks[i] for i in missing]
+    if dv is None:
+        computed = (get_mean_files(parts, var_names, times_at_once, wt,
+                                   prefetch, percentiles)
+                    for parts in missing_chunks)
+    else:
+        computed = _iter_balanced(c, dv, missing_chunks, var_names,
+                                  times_at_once, wt, prefetch, percentiles,
+                                  max_pending, retries)
+    missing = set(missing)
+    with closing(computed):
+        for i, key in enumerate(keys):
+            if i in missing:
+                result = next(computed)
+                store.put(key, result)
+            else:
+                result = store.get(key, store)
+                if result is store:
+                    # stored, but can't be read
+                    result = get_mean_files(chunks[i], var_names,
+                                            times_at_once, wt, prefetch,
+                                            percentiles)
+                    store.put(key, result)
+            yield result
 
 
 def run (files, var_name, start = 0, end = None, parallel = True,
          engines = None, time_name = 'time', lat_name = 'lat',
-         lon_name = 'lon', times_at_once = 1000):
+         lon_name = 'lon', times_at_once = 1000, prefetch = 2,
+         stats = None, balanced = False, retries = 2, checkpoint = None,
+         cache = False, refresh = False, output = None, session = None):
     """Run a global mean on a dataset.
 
 run(files, var_name, start = 0, end = None, parallel = True, engines = None,
     time_name = 'time', lat_name = 'lat', lon_name = 'lon',
-    time_at_once = 1000) -> (times, mean)
+    time_at_once = 1000, prefetch = 2, stats = None, balanced = False,
+    retries = 2, checkpoint = None, cache = False, refresh = False,
+    output = None, session = None) -> (times, mean)
 
 files: as taken by netCDF4.MFDataset.
-var_name: the name of the variable to compute the mean of.
+var_name: the name of the variable to compute the mean of, or a list of names
+          of variables on the same grid to compute means of together.  Each
+          block of times is read for all of them at once, and the times and
+          weights are only worked out once.
 start: the index in the time variable to start at (this index is included).
 end: the index in the time variable to end at (this index is not included);
      defaults to the variable's length.
@@ -143,45 +508,320 @@ engines: a list of engines to use if running in parallel.  The default is to
 time_name, lat_name, lon_name: the names of these variables.  time can actually
                                be any one-dimensional variable, but longitude
                                and latitude must be 'the' longitude and
-                               latitude for var, in standard format.
+                               latitude for var, in standard format.  Area
+                               weights are computed from them and their
+                               bounds (see nc_ipython.gridweights).
 times at once: the number of times to retrieve data for before processing it.
                Note that this much may be in memory at any time on every
                engine, for parallel runs.
+prefetch: the number of blocks of times_at_once times to read in the background
+          while working on the current one (see
+          ncserialisable.Variable.iter_blocks).  Up to prefetch + 2 blocks may
+          be in memory at once.
+stats: a list of statistics to compute instead of just the mean, as taken by
+       finish_stats (eg. ('mean', 'std', 'min', 'max', 'p5', 'p95')).  These
+       are all computed in the same pass over the data.
+balanced: for parallel runs, whether to split the range into chunks of around
+          times_at_once times (aligned with the storage) and hand them to
+          engines as they become free, rather than giving each engine one
+          equal piece.  This is faster when some engines or files are slower
+          than others.
+retries: for balanced runs, the number of times to retry a chunk on another
+         engine if it fails (including if its engine dies).
+checkpoint: a directory (or nc_ipython.checkpoint.CheckpointStore instance) to
+            store the result for each chunk in.  The range is split into
+            chunks as for balanced runs (parallel runs are always balanced),
+            and chunks whose results are already stored aren't computed
+            again.  Chunks are identified by the file (including its
+            modification time and size) and range within it, as well as the
+            variables, statistics and weights, so running again after a run
+            fails, or after adding files, only computes the chunks that are
+            missing or have changed.
+cache: whether to use the result cache (see nc_ipython.resultcache): if a run
+       with the same files (with the same modification times and sizes),
+       variables, range and statistics was done before with the same version
+       of this module and nc_ipython, its result is returned without reading
+       the files.  Off by default.
+refresh: whether to compute the result even if it's cached, replacing the
+         cached result.
+output: the path of a netCDF file to write the results to instead of returning
+        them.  Results are written a chunk of times at a time as they're
+        ready (see run_iter and nc_ipython.ncoutput.OutputFile), so only a
+        few chunks are in memory at once.  The file has a variable named after
+        each variable (or '<var>_<stat>' for each statistic, if stats is
+        given), and the time variable (with its bounds, if it has them),
+        metadata and other coordinates are copied from the dataset.  With
+        output, parallel runs are always balanced, and results aren't cached.
+session: an nc_ipython.session.Session to use instead of engines.  Functions
+         and weights are only pushed to the engines once, and files stay open
+         on them between runs (with data read from them kept up to the
+         session's max_memory).
 
 times: an array of times from the time variable, for the given time range.
-mean: a corresponding array of means over the var variable for each time.  Each
-      mean is taken over lat and lon for the 0th index of any other dimensions.
+mean: a corresponding array of area-weighted means over lat and lon of the var
+      variable for each time.  Any other dimensions (such as levels) are kept,
+      following time.  If stats is given, this is instead a dict of such arrays
+      for each statistic, as returned by finish_stats.  If var_name is a list,
+      this is a dict of such results for each variable.
+If output is given, output is returned instead.
 
 """
+    if output is not None:
+        results = run_iter(files, var_name, start, end, parallel, engines,
+                           time_name, lat_name, lon_name, times_at_once,
+                           prefetch, stats, retries, checkpoint = checkpoint,
+                           session = session)
+        _write_output(output, aggregation_index(files, time_name), start,
+                      var_name, stats, time_name, lat_name, lon_name, results)
+        return output
+
+    if cache:
+        key = ('globalmean.run', resultcache.code_version(__name__),
+               resultcache.file_stamps(files),
+               var_name if isinstance(var_name, basestring)
+               else tuple(var_name),
+               start, end, time_name, lat_name, lon_name,
+               None if stats is None else tuple(stats))
+        compute = lambda: run(files, var_name, start, end, parallel, engines,
+                              time_name, lat_name, lon_name, times_at_once,
+                              prefetch, stats, balanced, retries, checkpoint,
+                              False, session = session)
+        return resultcache.cached(key, compute, refresh)
+
     if parallel:
-        c = Client()
-        dv = c[:]
-        if engines is not None:
-            dv.targets = engines
-        dv.block = True
-        dv.execute('import numpy')
-        dv.execute('from netCDF4 import MFDataset')
-    # get weightings
-    fs = files
-    if isinstance(fs, basestring):
-        fs = glob(fs)
-    f = cdms2.open(fs[0])
-    try:
-        wt = numpy.outer(*f[var_name].getGrid().getWeights())
-    finally:
-        f.close()
-    with MFDataset(files) as d:
-        # get end time
-        time = d.variables[time_name]
-        n = len(time)
-        if end is None or end > n:
-            end = n
+        c, dv = _get_view(engines, session)
+    index, wt, end = _prepare(files, time_name, lat_name, lon_name, end,
+                              session)
+    files = index.files
+    if parallel and not balanced:
+        # split between engines to suit the storage
+        chunk_size = _chunk_size(index, var_name, time_name)
+        pieces = index.partition(len(dv.targets), start, end, chunk_size)
     # run
     var_names = (time_name, lat_name, lon_name, var_name)
+    percentiles = () if stats is None else _percentiles(stats)
+    if checkpoint is not None:
+        if not isinstance(checkpoint, CheckpointStore):
+            checkpoint = CheckpointStore(checkpoint)
+        chunks = _chunks(index, start, end, var_names, times_at_once)
+        if not parallel:
+            c = dv = None
+        times, data = zip(*_iter_checkpointed(c, dv, index, chunks,
+                                              checkpoint, var_names,
+                                              times_at_once, wt, prefetch,
+                                              percentiles, None, retries))
+        times = numpy.hstack(times)
+        partial = _join(data, var_name)
+    elif parallel and balanced:
+        chunks = _chunks(index, start, end, var_names, times_at_once)
+        times, data = zip(*_iter_balanced(c, dv, chunks, var_names,
+                                          times_at_once, wt, prefetch,
+                                          percentiles, None, retries))
+        times = numpy.hstack(times)
+        partial = _join(data, var_name)
+    elif parallel:
+        times, partial = get_mean_parallel(dv, files, start, end, var_names,
+                                           times_at_once, wt, pieces,
+                                           prefetch, percentiles)
+    else:
+        times, partial = get_mean_serial(files, start, end, var_names,
+                                         times_at_once, wt, prefetch,
+                                         percentiles)
+    return (times, _finish(partial, stats, var_name))
+
+
+def run_iter (files, var_name, start = 0, end = None, parallel = True,
+              engines = None, time_name = 'time', lat_name = 'lat',
+              lon_name = 'lon', times_at_once = 1000, prefetch = 2,
+              stats = None, retries = 2, max_pending = None,
+              checkpoint = None, session = None):
+    """Run a global mean on a dataset, yielding results as they're ready.
+
+run_iter(files, var_name, start = 0, end = None, parallel = True,
+         engines = None, time_name = 'time', lat_name = 'lat',
+         lon_name = 'lon', time_at_once = 1000, prefetch = 2, stats = None,
+         retries = 2, max_pending = None, checkpoint = None, session = None)
+    -> iterator
+
+Takes the same arguments as run (parallel runs are always balanced), plus:
+
+max_pending: for parallel runs, the most chunks to have queued or running on
+             engines at once; defaults to twice the number of engines.
+
+This yields (times, mean) for consecutive ranges of times, in order, where each
+is as returned by run for that range; joining them gives run's result.
+
+For parallel runs, the range is split into chunks of around times_at_once times
+(aligned with the storage), which are handed to engines as they become free.
+Results that arrive before earlier chunks' results are held until those are
+yielded.  No more than max_pending chunks are in progress at once, so memory
+use depends on times_at_once rather than the length of the range.  Each engine
+opens the files only once for all the chunks it works on (see
+ncserialisable.Dataset.deferred).  With checkpoint, serial runs are split into
+chunks in the same way, and results are yielded a chunk at a time.
+
+"""
     if parallel:
-        results = get_mean_parallel(dv, files, start, end, var_names,
-                                    times_at_once, wt)
+        c, dv = _get_view(engines, session)
+    index, wt, end = _prepare(files, time_name, lat_name, lon_name, end,
+                              session)
+    var_names = (time_name, lat_name, lon_name, var_name)
+    percentiles = () if stats is None else _percentiles(stats)
+    if parallel and max_pending is None:
+        max_pending = 2 * len(dv.targets)
+    if checkpoint is not None:
+        if not isinstance(checkpoint, CheckpointStore):
+            checkpoint = CheckpointStore(checkpoint)
+        chunks = _chunks(index, start, end, var_names, times_at_once)
+        if not parallel:
+            c = dv = None
+        for times, partial in _iter_checkpointed(c, dv, index, chunks,
+                                                 checkpoint, var_names,
+                                                 times_at_once, wt, prefetch,
+                                                 percentiles, max_pending,
+                                                 retries):
+            yield (times, _finish(partial, stats, var_name))
+        return
+
+    if not parallel:
+        for times, partial in iter_mean_serial(index.files, start, end,
+                                               var_names, times_at_once, wt,
+                                               prefetch, percentiles):
+            yield (times, _finish(partial, stats, var_name))
+        return
+
+    chunks = _chunks(index, start, end, var_names, times_at_once)
+    for times, partial in _iter_balanced(c, dv, chunks, var_names,
+                                         times_at_once, wt, prefetch,
+                                         percentiles, max_pending, retries):
+        yield (times, _finish(partial, stats, var_name))
+
+
+# cell_methods for statistics
+_cell_methods = {'mean': 'mean', 'var': 'variance',
+                 'std': 'standard_deviation', 'min': 'minimum',
+                 'max': 'maximum'}
+
+
+def _write_output (path, index, start, var_name, stats, time_name, lat_name,
+                   lon_name, results):
+    # write results from run_iter to a netCDF file, with time bounds read from
+    # the files for each chunk if the time variable has them
+    names = [var_name] if isinstance(var_name, basestring) else var_name
+    with Dataset(index.files[0]) as d:
+        time = d.variables[time_name]
+        bounds_name = getattr(time, 'bounds', None)
+        if bounds_name not in d.variables:
+            bounds_name = None
+        out = OutputFile(path, time, bounds_name is not None)
+        try:
+            grid_dims = [time.dimensions[0],
+                         d.variables[lat_name].dimensions[0],
+                         d.variables[lon_name].dimensions[0]]
+            for name in names:
+                var = d.variables[name]
+                dims = [dim for dim in var.dimensions if dim not in grid_dims]
+                for stat in (['mean'] if stats is None else stats):
+                    attrs = {}
+                    if stat in _cell_methods:
+                        attrs['cell_methods'] = 'area: ' + _cell_methods[stat]
+                    out.add_variable(
+                        name if stats is None else '{0}_{1}'.format(name,
+                                                                    stat),
+                        var, dims, numpy.float64, attrs
+                    )
+        except:
+            out.close()
+            raise
+
+    with out:
+        t0 = start
+        for times, mean in results:
+            t1 = t0 + len(times)
+            bounds = None
+            if bounds_name is not None:
+                bounds = []
+                for f, f0, f1, offset in index.file_ranges(t0, t1):
+                    with Dataset.deferred(f) as d:
+                        bounds.append(d.variables[bounds_name][f0:f1])
+                bounds = numpy.concatenate(bounds)
+            if names is not var_name:
+                mean = {var_name: mean}
+            # times with no data are NaN: store them as missing
+            values = {}
+            for name in names:
+                if stats is None:
+                    values[name] = numpy.ma.masked_invalid(mean[name])
+                else:
+                    for stat in stats:
+                        values['{0}_{1}'.format(name, stat)] = \
+                            numpy.ma.masked_invalid(mean[name][stat])
+            out.append(times, values, bounds)
+            t0 = t1
+
+
+def _get_view (engines, session = None):
+    # client and blocking DirectView for run and run_iter, or session
+    if session is not None:
+        return (session.client, session)
+    c = Client()
+    dv = c[:]
+    if engines is not None:
+        dv.targets = engines
+    dv.block = True
+    return (c, dv)
+
+
+def _prepare (files, time_name, lat_name, lon_name, end, session = None):
+    # index, weights and end index for run and run_iter; the index and weights
+    # are kept by session if given
+    def compute ():
+        # summarise the files without opening them all; engines then use the
+        # resolved file list rather than each matching a pattern
+        index = aggregation_index(files, time_name)
+        # get weightings (variables computed together share a grid)
+        wt = area_weights(index.files[0], lat_name, lon_name)
+        return (index, wt)
+    if session is None:
+        index, wt = compute()
+    else:
+        session.check_files(files)
+        index, wt = session.cached(('globalmean.prepare', repr(files),
+                                    time_name, lat_name, lon_name), compute)
+    # get end time
+    n = len(index)
+    if end is None or end > n:
+        end = n
+    return (index, wt, end)
+
+
+def _chunk_size (index, var_name, time_name):
+    # size of storage chunks along time, or None if not chunked; for several
+    # variables, the first is used
+    if not isinstance(var_name, basestring):
+        var_name = var_name[0]
+    with Dataset(index.files[0]) as d:
+        var = d.variables[var_name]
+        time_index = var.dimensions.index(
+            d.variables[time_name].dimensions[0])
+        chunks = var.chunk_shape()
+    return None if chunks is None else chunks[time_index]
+
+
+def _join (data, var_name):
+    # join_stats for results for one variable or a list of variables
+    if isinstance(var_name, basestring):
+        return join_stats(data)
+    return dict((name, join_stats([partials[name] for partials in data]))
+                for name in var_name)
+
+
+def _finish (partial, stats, var_name):
+    # results returned by run for partial statistics
+    if not isinstance(var_name, basestring):
+        return dict((name, _finish(partial[name], stats, name))
+                    for name in var_name)
+    if stats is None:
+        return finish_stats(partial)['mean']
     else:
-        results = get_mean_serial(files, start, end, var_names, times_at_once,
-                                  wt)
-    return results
\ No newline at end of file
+        return finish_stats(partial, stats)
\ No newline at end of file
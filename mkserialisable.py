@@ -10,11 +10,17 @@ mk_ellipsis: Ellipsis.
 mk_slots: classes with __slots__ but not __dict__.
 mk_netcdf: netCDF4.
 mk_cf: cf.
+mk_numpy: numpy arrays (out-of-band, for IPython.parallel).
 
 """
 
 import copy_reg
 
+try:
+    from IPython.utils.pickleutil import CannedObject as _CannedObject
+except ImportError:
+    _CannedObject = object
+
 _done = []
 
 # ellipsis
@@ -67,6 +73,172 @@ Call this before importing any module that uses netCDF4.
 
     sys.modules['netCDF4'] = ncserialisable
 
+# numpy
+
+# containers are only searched for arrays up to this size and depth, as for
+# IPython's own canning
+_max_items = 64
+_max_depth = 4
+
+
+class _ArrayHeader (object):
+    # where to find an array's data in _CannedArrays.buffers
+    __slots__ = ('dtype', 'shape', 'data', 'mask', 'fill_value', 'hard_mask')
+
+    def __init__ (self, dtype, shape, data, mask = None, fill_value = None,
+                  hard_mask = None):
+        self.dtype = dtype
+        self.shape = shape
+        self.data = data
+        self.mask = mask
+        self.fill_value = fill_value
+        self.hard_mask = hard_mask
+
+    def __getstate__ (self):
+        return tuple(getattr(self, k) for k in self.__slots__)
+
+    def __setstate__ (self, state):
+        for k, v in zip(self.__slots__, state):
+            setattr(self, k, v)
+
+
+def _can_buffer (a):
+    # raw buffer for an array's data; numpy is imported by the caller
+    return buffer(numpy.ascontiguousarray(a))
+
+
+def _sendable (a):
+    # whether an array's data can be sent as a raw buffer
+    dt = a.dtype
+    return (a.size and not dt.hasobject and
+            type(a) in (numpy.ndarray, numpy.ma.MaskedArray))
+
+
+class _CannedArrays (_CannedObject):
+    # numpy arrays (possibly masked) within nested tuples, lists and dicts;
+    # array data goes in self.buffers, which IPython sends without pickling
+    # or copying, and everything else (including a header for each array) in
+    # self.obj
+
+    def __init__ (self, obj):
+        self.buffers = []
+        self.obj = self._can(obj)
+
+    def _can (self, obj):
+        if isinstance(obj, numpy.ndarray):
+            if not _sendable(obj):
+                return obj
+            dt = obj.dtype
+            h = _ArrayHeader(dt.descr if dt.fields else dt.str, obj.shape,
+                             len(self.buffers))
+            self.buffers.append(_can_buffer(obj))
+            if isinstance(obj, numpy.ma.MaskedArray):
+                mask = numpy.ma.getmask(obj)
+                if mask is not numpy.ma.nomask:
+                    h.mask = len(self.buffers)
+                    self.buffers.append(_can_buffer(mask))
+                h.fill_value = obj.fill_value
+                h.hard_mask = obj.hardmask
+            return h
+        elif type(obj) in (tuple, list):
+            return type(obj)(self._can(x) for x in obj)
+        elif type(obj) is dict:
+            return dict((k, self._can(v)) for k, v in obj.iteritems())
+        else:
+            return obj
+
+    def _uncan (self, obj):
+        if type(obj) is _ArrayHeader:
+            dt = numpy.dtype(obj.dtype)
+            a = numpy.frombuffer(self.buffers[obj.data], dt)
+            a = a.reshape(obj.shape)
+            if obj.hard_mask is None:
+                return a
+            if obj.mask is None:
+                mask = numpy.ma.nomask
+            else:
+                mask = numpy.frombuffer(self.buffers[obj.mask],
+                                        numpy.ma.make_mask_descr(dt))
+                mask = mask.reshape(obj.shape)
+            return numpy.ma.MaskedArray(a, mask, copy = False,
+                                        fill_value = obj.fill_value,
+                                        hard_mask = obj.hard_mask)
+        elif type(obj) in (tuple, list):
+            return type(obj)(self._uncan(x) for x in obj)
+        elif type(obj) is dict:
+            return dict((k, self._uncan(v)) for k, v in obj.iteritems())
+        else:
+            return obj
+
+    def get_object (self, g = None):
+        return self._uncan(self.obj)
+
+    def __getstate__ (self):
+        # buffers not taken out for sending separately (those IPython thinks
+        # are too small, or if nested within another canned object) need to be
+        # copied to be pickled
+        state = self.__dict__.copy()
+        state['buffers'] = [b if b is None or isinstance(b, bytes)
+                            else bytes(b) for b in self.buffers]
+        return state
+
+
+def _has_arrays (obj, depth = 0):
+    # whether a container has any arrays worth canning
+    if isinstance(obj, numpy.ndarray):
+        return _sendable(obj)
+    elif depth >= _max_depth:
+        return False
+    elif type(obj) in (tuple, list):
+        return (len(obj) <= _max_items and
+                any(_has_arrays(x, depth + 1) for x in obj))
+    elif type(obj) is dict:
+        return (len(obj) <= _max_items and
+                any(_has_arrays(x, depth + 1) for x in obj.itervalues()))
+    else:
+        return False
+
+
+def _can_arrays (obj):
+    if _has_arrays(obj):
+        return _CannedArrays(obj)
+    else:
+        return obj
+
+
+def mk_numpy ():
+    """Send numpy arrays efficiently with IPython.parallel.
+
+Depends on IPython and numpy.  IPython already sends the data of numpy.ndarray
+objects as raw buffers alongside the message, rather than pickling them, but
+only for arrays that are values pushed, arguments, results or items of these.
+This does the same for masked arrays (as returned by netCDF4 variables),
+sending the data and mask as separate buffers, and for arrays nested (a few
+levels deep) in tuples, lists and dicts.  Only a small header with the dtype,
+shape and masked array attributes is pickled.
+
+Arrays are reconstructed on the receiving side directly from the received
+buffers without copying, and so are read-only, just like IPython's own plain
+arrays.
+
+Call this in both the client and the engines (the engines send results back).
+
+"""
+    if 'numpy' in _done:
+        return
+
+    global numpy
+    import numpy
+    from IPython.utils import pickleutil
+
+    can_map = pickleutil.can_map
+    # resolve IPython's own string keys first: they're replaced in the map when
+    # first used, which would undo any of ours for the same type
+    pickleutil._import_mapping(can_map, pickleutil._original_can_map)
+    for cls in (numpy.ma.MaskedArray, tuple, list, dict):
+        can_map[cls] = _can_arrays
+    _done.append('numpy')
+
 # cf
 
 def _construct_cf_units (attrs):
@@ -0,0 +1,175 @@
+"""Hand out tasks to IPython engines, keeping related tasks on the same engine.
+
+IPython's LoadBalancedView sends each task to whichever engine is free, which
+balances the load but ignores what engines have already done: a task reading a
+file is as likely to go to an engine that has never opened it as to the one
+that just read the rest of it (and so has it open and in the page cache of its
+host).  This module schedules tasks itself, over DirectViews, so that each free
+engine is given a task with the same key (such as a file path) as one it ran
+recently where there is one.
+
+See the iter_affinity function.
+
+"""
+
+from collections import deque, defaultdict, Counter
+from bisect import insort, bisect_left
+
+
+def _first (unsent, limit, exclude):
+    # the earliest of the negated, sorted indices in unsent that is before
+    # limit and not excluded, or None
+    for j in xrange(len(unsent) - 1, -1, -1):
+        i = -unsent[j]
+        if i >= limit:
+            return None
+        if i not in exclude:
+            return i
+    return None
+
+
+def _choose (unsent, limit, recent, active, mine, exclude):
+    # pick the task for an engine: the first with a recently used key, else
+    # the first with a key no other engine is using, else the first; only
+    # tasks before limit and not excluded are considered; returns the task's
+    # index and key, or None
+    first = unclaimed = used = None
+    for key, indices in unsent.iteritems():
+        i = _first(indices, limit, exclude)
+        if i is None:
+            continue
+        if key in recent:
+            if used is None or i < used[0]:
+                used = (i, key)
+        elif active[key] <= mine[key]:
+            if unclaimed is None or i < unclaimed[0]:
+                unclaimed = (i, key)
+        if first is None or i < first[0]:
+            first = (i, key)
+    if used is not None:
+        return used
+    return first if unclaimed is None else unclaimed
+
+
+def iter_affinity (client, targets, f, tasks, keys, max_pending = None,
+                   per_engine = 2, retries = 2, history = 4):
+    """Run tasks on engines, preferring engines that used the same key.
+
+iter_affinity(client, targets, f, tasks, keys, max_pending = None,
+              per_engine = 2, retries = 2, history = 4) -> iterator
+
+client: IPython.parallel.Client instance.
+targets: the ids of the engines to use.
+f: the function to run; it must be possible to call it on the engines.
+tasks: a list of argument tuples to call f with.
+keys: a corresponding list of keys (any hashable values), such as the file
+      each task reads.
+max_pending: the most tasks to have started ahead of the earliest task whose
+             result hasn't been yielded yet.  The default is no limit.  Results
+             that arrive early are held until they can be yielded in order, so
+             this bounds how many are held at once.
+per_engine: the most tasks to have sent to an engine at once; more than 1 lets
+            an engine start on its next task while the last result is
+            returned.
+retries: the number of times to retry a task if it fails, on another engine
+         where possible.  Engines that die are no longer used.
+history: the number of the most recent keys to remember for each engine.
+
+Yields the result of f(*task) for each task, in order.
+
+Each time an engine can take a task, it's given the earliest task (within
+max_pending) with one of its recent keys.  If there are none, it's given the
+earliest task with a key that no other engine is running a task with, so that
+engines spread out over different keys, or failing that, the earliest task.
+
+"""
+    n = len(tasks)
+    if max_pending is None:
+        max_pending = n
+    engines = list(targets)
+    if not engines:
+        raise ValueError('no engines to use')
+    views = dict((e, client[e]) for e in engines)
+    recent = dict((e, deque(maxlen = history)) for e in engines)
+    # engine: {msg_id: (task index, AsyncResult)}
+    running = dict((e, {}) for e in engines)
+    # msg_ids of running tasks, and the engine running each
+    pending = {}
+    # number of running tasks with each key, in all and on each engine
+    active = Counter()
+    mine = dict((e, Counter()) for e in engines)
+    # key: negated indices of unsent tasks, sorted, so the earliest is last
+    unsent = defaultdict(list)
+    for i in xrange(n - 1, -1, -1):
+        unsent[keys[i]].append(-i)
+    tries = [0] * n
+    # engine: indices of tasks that failed on it
+    failed = {}
+    done = {}
+    next_i = 0
+    changed = True
+    try:
+        while next_i < n:
+            # yield results that are ready, in order
+            while next_i in done:
+                yield done.pop(next_i)
+                next_i += 1
+            if next_i >= n:
+                break
+            # give engines tasks, if anything's changed since last time
+            limit = next_i + max_pending
+            for e in engines if changed else ():
+                while len(running[e]) < per_engine:
+                    chosen = _choose(unsent, limit, recent[e], active, mine[e],
+                                     failed.get(e, ()))
+                    if chosen is None:
+                        break
+                    i, key = chosen
+                    indices = unsent[key]
+                    del indices[bisect_left(indices, -i)]
+                    if not indices:
+                        del unsent[key]
+                    ar = views[e].apply_async(f, *tasks[i])
+                    msg_id = ar.msg_ids[0]
+                    running[e][msg_id] = (i, ar)
+                    pending[msg_id] = e
+                    active[key] += 1
+                    mine[e][key] += 1
+                    recent[e].append(key)
+            # wait for results
+            if not pending:
+                raise RuntimeError('no engines left to run tasks')
+            client.wait(pending, timeout = .01)
+            finished = set(pending).difference(client.outstanding)
+            changed = bool(finished)
+            for msg_id in finished:
+                e = pending.pop(msg_id)
+                r = running[e]
+                i, ar = r.pop(msg_id)
+                active[keys[i]] -= 1
+                mine[e][keys[i]] -= 1
+                try:
+                    done[i] = ar.get()
+                except Exception:
+                    tries[i] += 1
+                    if tries[i] > retries:
+                        raise
+                    if e in engines and e not in client.ids:
+                        # engine died
+                        engines.remove(e)
+                    # don't retry on this engine, unless there's no other
+                    exclude = failed.setdefault(e, set())
+                    exclude.add(i)
+                    if all(i in failed.get(other, ())
+                           for other in engines):
+                        for other in engines:
+                            failed[other].discard(i)
+                    insort(unsent[keys[i]], -i)
+                if not r and e not in engines:
+                    del running[e]
+    finally:
+        # stopped early: don't leave work queued
+        for r in running.itervalues():
+            for i, ar in r.itervalues():
+                if not ar.ready():
+                    ar.abort()
@@ -0,0 +1,243 @@
+"""A cached summary of the files making up a netCDF4.MFDataset.
+
+Opening an MFDataset opens every file in it, which for a large set of files can
+take a long time.  Often, all that's needed is the list of files, how the time
+dimension is split between them and the times at either end; this module
+provides that, caching it on disk so that it only needs working out again for
+files that have changed.
+
+See the aggregation_index function.
+
+"""
+
+import os
+import json
+import threading
+from glob import glob
+from hashlib import sha1
+from tempfile import mkstemp
+
+import netCDF4
+
+from nc_ipython.ncserialisable import _partition
+
+_index_dir = os.path.join(os.path.expanduser('~'), '.nc_ipython', 'index')
+# directory: (time_name, records), as loaded from/saved to the index directory
+_records = {}
+_lock = threading.Lock()
+
+
+def set_index_dir (path):
+    """Set the directory aggregation indices are stored in.
+
+set_index_dir(path)
+
+path: the directory; it's created if needed.  If None, indices are only kept in
+      memory.  The default is ~/.nc_ipython/index.
+
+"""
+    global _index_dir
+    with _lock:
+        _index_dir = path
+        _records.clear()
+
+
+def _record_file (directory, time_name):
+    # path of the index file for files in the given directory
+    key = sha1('{0}\0{1}'.format(directory, time_name)).hexdigest()
+    return os.path.join(_index_dir, key + '.json')
+
+
+def _load_records (directory, time_name):
+    # get the records for a directory, from memory or disk
+    key = (directory, time_name)
+    if key not in _records:
+        records = {}
+        if _index_dir is not None:
+            try:
+                with open(_record_file(directory, time_name)) as f:
+                    records = json.load(f)['files']
+            except (IOError, ValueError, KeyError):
+                pass
+        _records[key] = records
+    return _records[key]
+
+
+def _save_records (directory, time_name):
+    # write the records for a directory to disk, replacing atomically
+    if _index_dir is None:
+        return
+    if not os.path.isdir(_index_dir):
+        os.makedirs(_index_dir)
+    fd, tmp = mkstemp(dir = _index_dir)
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump({'directory': directory, 'time_name': time_name,
+                       'files': _records[(directory, time_name)]}, f)
+        os.rename(tmp, _record_file(directory, time_name))
+    except:
+        os.remove(tmp)
+        raise
+
+
+def _read_record (path, time_name):
+    # summarise a single file
+    with netCDF4.Dataset(path) as d:
+        t = d.variables[time_name]
+        l = len(t)
+        record = {
+            'length': l,
+            'first': float(t[0]) if l else None,
+            'last': float(t[-1]) if l else None,
+            'units': getattr(t, 'units', None),
+            'calendar': getattr(t, 'calendar', 'standard')
+        }
+    return record
+
+
+def resolve_files (files):
+    """Get the list of files an MFDataset would open.
+
+resolve_files(files) -> paths
+
+files: as taken by netCDF4.MFDataset: a glob pattern or list of paths.
+
+paths: a list of absolute paths, in the order netCDF4.MFDataset uses them.
+
+"""
+    if isinstance(files, basestring):
+        files = sorted(glob(files))
+        if not files:
+            raise IOError('no files match the pattern')
+    return [os.path.abspath(f) for f in files]
+
+
+class AggregationIndex (object):
+    """A summary of the files in an MFDataset, along its time dimension.
+
+Don't create these directly; use aggregation_index.
+
+Attributes:
+
+files: the paths of the files, in order (see resolve_files).
+lengths: the length of the time dimension in each file.
+bounds: the indices where each file starts along the time dimension, followed
+        by the total length (like ncserialisable.Variable.file_bounds).
+first, last: the first and last raw time values in each file (None for empty
+             files).
+stamps: the [modification time, size] of each file when it was summarised.
+units, calendar: from the time variable in the first file.
+time_name: the name of the time variable.
+
+"""
+
+    def __init__ (self, files, records, time_name):
+        self.files = files
+        self.time_name = time_name
+        self.lengths = [r['length'] for r in records]
+        self.first = [r['first'] for r in records]
+        self.last = [r['last'] for r in records]
+        self.stamps = [r['stamp'] for r in records]
+        self.units = records[0]['units'] if records else None
+        self.calendar = records[0]['calendar'] if records else 'standard'
+        self.bounds = [0]
+        for l in self.lengths:
+            self.bounds.append(self.bounds[-1] + l)
+
+    def __len__ (self):
+        return self.bounds[-1]
+
+    def time_bounds (self):
+        """Get first and last times, and length of the time variable.
+
+time_bounds() -> (first, last, length)
+
+As returned by seasonalmean.time_bounds.
+
+"""
+        firsts = [t for t in self.first if t is not None]
+        if not firsts:
+            return (None, None, 0)
+        lasts = [t for t in self.last if t is not None]
+        times = netCDF4.num2date((firsts[0], lasts[-1]), self.units,
+                                 self.calendar)
+        return tuple(times) + (len(self),)
+
+    def partition (self, n_pieces, start = 0, end = None, chunk_size = None):
+        """Split a range of the time dimension to suit the storage.
+
+partition(n_pieces, start = 0, end = None, chunk_size = None)
+    -> list_of_ranges
+
+chunk_size: the size of chunks along the time dimension within each file, if
+            known.
+
+Like ncserialisable.Variable.partition for the time dimension, without needing
+the files to be open.
+
+"""
+        if end is None:
+            end = len(self)
+        chunk_bounds = []
+        if chunk_size is not None:
+            for f0, f1 in zip(self.bounds[:-1], self.bounds[1:]):
+                chunk_bounds.extend(xrange(f0, f1, chunk_size))
+        return _partition(n_pieces, start, end, (self.bounds, chunk_bounds))
+
+    def file_ranges (self, start = 0, end = None):
+        """Find the parts of files covering a range of the time dimension.
+
+file_ranges(start = 0, end = None) -> parts
+
+parts: a list of (path, file_start, file_end, offset) tuples in order, where
+       indices file_start:file_end in the file at path cover indices
+       offset + file_start:offset + file_end in the whole dataset.
+
+"""
+        if end is None:
+            end = len(self)
+        parts = []
+        for path, f0, f1 in zip(self.files, self.bounds[:-1], self.bounds[1:]):
+            s0 = max(start, f0)
+            s1 = min(end, f1)
+            if s0 < s1:
+                parts.append((path, s0 - f0, s1 - f0, f0))
+        return parts
+
+
+def aggregation_index (files, time_name = 'time'):
+    """Get the aggregation index for a set of files.
+
+aggregation_index(files, time_name = 'time') -> index
+
+files: as taken by netCDF4.MFDataset.
+time_name: the name of the time variable; can actually be any variable along
+           the aggregated dimension.
+
+index: an AggregationIndex instance.
+
+The summary of each file is stored in the index directory (see set_index_dir)
+with the file's modification time and size, and only worked out again (by
+opening the file) if these change.  Only files are stat-ed, so this is much
+faster than opening an MFDataset.
+
+"""
+    paths = resolve_files(files)
+    records = []
+    with _lock:
+        changed = set()
+        for path in paths:
+            directory, name = os.path.split(path)
+            stored = _load_records(directory, time_name)
+            st = os.stat(path)
+            stamp = [st.st_mtime, st.st_size]
+            record = stored.get(name)
+            if record is None or record['stamp'] != stamp:
+                record = _read_record(path, time_name)
+                record['stamp'] = stamp
+                stored[name] = record
+                changed.add(directory)
+            records.append(record)
+        for directory in changed:
+            _save_records(directory, time_name)
+    return AggregationIndex(paths, records, time_name)
@@ -0,0 +1,150 @@
+"""Vectorised calendar arithmetic for CF time variables.
+
+netCDF4.num2date turns each time into a datetime object, which is slow for long
+time axes when all that's needed is the year and month of each time.  This
+module works these out with numpy arithmetic on the raw time values, for all
+the CF calendars.
+
+See the year_month function.
+
+"""
+
+import re
+
+import numpy
+
+_unit_seconds = {
+    'microseconds': 1e-6, 'microsecond': 1e-6, 'us': 1e-6,
+    'milliseconds': 1e-3, 'millisecond': 1e-3, 'ms': 1e-3,
+    'seconds': 1, 'second': 1, 'secs': 1, 'sec': 1, 's': 1,
+    'minutes': 60, 'minute': 60, 'mins': 60, 'min': 60,
+    'hours': 3600, 'hour': 3600, 'hrs': 3600, 'hr': 3600, 'h': 3600,
+    'days': 86400, 'day': 86400, 'd': 86400
+}
+_units_re = re.compile(
+    r'^\s*(\w+)\s+since\s+(-?\d+)-(\d+)-(\d+)'
+    r'(?:[T\s]+(\d+):(\d+)(?::(\d+(?:\.\d*)?))?)?'
+    r'\s*(Z|UTC|[+-]\d+(?::?\d+)?)?\s*$', re.IGNORECASE
+)
+_tz_re = re.compile(r'^([+-])(\d\d)(?::?(\d\d))?$')
+_calendars = {
+    'standard': 'standard', 'gregorian': 'standard',
+    'proleptic_gregorian': 'proleptic_gregorian', 'julian': 'julian',
+    'noleap': 'noleap', '365_day': 'noleap',
+    'all_leap': 'all_leap', '366_day': 'all_leap', '360_day': '360_day'
+}
+# cumulative days before each month, for fixed-length years
+_month_starts = {
+    'noleap': numpy.cumsum([0, 31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30]),
+    'all_leap': numpy.cumsum([0, 31, 29, 31, 30, 31, 30, 31, 31, 30, 31, 30]),
+    '360_day': numpy.arange(0, 360, 30)
+}
+_year_days = {'noleap': 365, 'all_leap': 366, '360_day': 360}
+# first day of the Gregorian calendar, for the standard calendar
+_gregorian_jdn = 2299161
+_day_us = 86400 * 10 ** 6
+
+
+def _parse_units (units):
+    # (seconds per unit, (year, month, day), microseconds into the day)
+    match = _units_re.match(units)
+    if match is None:
+        raise ValueError('can\'t parse time units: {0!r}'.format(units))
+    unit, y, m, d, hour, minute, second, tz = match.groups()
+    if unit.lower() not in _unit_seconds:
+        raise ValueError('unsupported time unit: {0!r}'.format(unit))
+    us = (int(hour or 0) * 3600 + int(minute or 0) * 60) * 10 ** 6
+    us += int(round(float(second or 0) * 10 ** 6))
+    tz = _tz_re.match(tz or '')
+    if tz is not None:
+        # convert to UTC (netCDF4.num2date ignores other forms of offset)
+        sign, tz_hours, tz_minutes = tz.groups()
+        tz_minutes = int(tz_hours) * 60 + int(tz_minutes or 0)
+        us -= (-1 if sign == '-' else 1) * tz_minutes * 60 * 10 ** 6
+    return (_unit_seconds[unit.lower()], (int(y), int(m), int(d)), us)
+
+
+def _jdn (y, m, d, julian):
+    # Julian day number of a date in the Gregorian or Julian calendar
+    a = (14 - m) // 12
+    y = y + 4800 - a
+    m = m + 12 * a - 3
+    jdn = d + (153 * m + 2) // 5 + 365 * y + y // 4
+    if julian:
+        return jdn - 32083
+    else:
+        return jdn - y // 100 + y // 400 - 32045
+
+
+def _from_jdn (jdn, julian):
+    # (year, month) arrays for Julian day numbers in the Gregorian or Julian
+    # calendar
+    if julian:
+        b = 0
+        c = jdn + 32082
+    else:
+        a = jdn + 32044
+        b = (4 * a + 3) // 146097
+        c = a - 146097 * b // 4
+    d = (4 * c + 3) // 1461
+    e = c - 1461 * d // 4
+    m = (5 * e + 2) // 153
+    return (100 * b + d - 4800 + m // 10, m + 3 - 12 * (m // 10))
+
+
+def year_month (times, units, calendar = 'standard'):
+    """Get the year and month of each of an array of CF times.
+
+year_month(times, units, calendar = 'standard') -> (years, months)
+
+times: array of raw time values.
+units, calendar: the units and calendar attributes of the time variable, as
+                 taken by netCDF4.num2date; units must be '<unit> since
+                 <date>' where unit is at most days.
+
+years, months: integer arrays of the year and month (1 to 12) of each time, as
+               given by the year and month attributes of the dates returned by
+               netCDF4.num2date.
+
+"""
+    if calendar.lower() not in _calendars:
+        raise ValueError('unsupported calendar: {0!r}'.format(calendar))
+    calendar = _calendars[calendar.lower()]
+    unit_seconds, (y, m, d), ref_us = _parse_units(units)
+    times = numpy.ma.filled(times, numpy.nan)
+    times = numpy.asarray(times, float).ravel()
+    if not numpy.isfinite(times).all():
+        raise ValueError('times must not be missing')
+    # whole days since the reference date, to the nearest microsecond
+    us = numpy.round(times * (unit_seconds * 10 ** 6)).astype(numpy.int64)
+    days = (us + ref_us) // _day_us
+
+    if calendar in _year_days:
+        # fixed-length years: count days from the start of year 0
+        starts = _month_starts[calendar]
+        year_days = _year_days[calendar]
+        days = days + (y * year_days + starts[m - 1] + d - 1)
+        years = days // year_days
+        months = numpy.searchsorted(starts, days - years * year_days,
+                                    'right')
+        return (years, months)
+
+    julian = calendar == 'julian'
+    if calendar == 'standard':
+        julian = (y, m, d) < (1582, 10, 15)
+    # these calendars have no year 0: 1 BC is year -1
+    if y < 0:
+        y += 1
+    jdn = days + _jdn(y, m, d, julian)
+    if calendar == 'standard':
+        # Julian before the switch to the Gregorian calendar
+        before = jdn < _gregorian_jdn
+        years, months = _from_jdn(jdn, False)
+        if before.any():
+            j_years, j_months = _from_jdn(jdn, True)
+            years = numpy.where(before, j_years, years)
+            months = numpy.where(before, j_months, months)
+    else:
+        years, months = _from_jdn(jdn, julian)
+    years[years <= 0] -= 1
+    return (years, months)
@@ -0,0 +1,109 @@
+"""A store of results on disk, for resuming long computations.
+
+A computation split into chunks can save each chunk's result as it's done, and
+look the results up when it's run again, so that only chunks that are missing
+(because they weren't done before, or because what they depend on changed)
+need computing.
+
+See the CheckpointStore class.
+
+"""
+
+import os
+import errno
+import cPickle as pickle
+from hashlib import sha1
+from tempfile import mkstemp
+
+
+class CheckpointStore (object):
+    """Results stored on disk by key.
+
+CheckpointStore(path)
+
+path: the directory to store results in; it's created if needed.
+
+Keys may be any values with a repr that identifies them, such as tuples of
+strings and numbers; they should include everything the result depends on.
+Values must be picklable.  Each result is stored in its own file, written
+atomically, so a store can be used by several processes at once, and results
+saved before a process dies are kept.
+
+"""
+
+    def __init__ (self, path):
+        self.path = path
+        if not os.path.isdir(path):
+            try:
+                os.makedirs(path)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+
+    def __getstate__ (self):
+        return self.path
+
+    def __setstate__ (self, path):
+        self.path = path
+
+    def _file (self, key):
+        # path of the file storing the result for key
+        return os.path.join(self.path, sha1(repr(key)).hexdigest() + '.pkl')
+
+    def __contains__ (self, key):
+        # only checks that there's a file for key, without reading it; get
+        # may still find it can't be read
+        return os.path.exists(self._file(key))
+
+    def get (self, key, default = None):
+        """Get a stored result.
+
+get(key, default = None) -> value
+
+value: the stored result, or default if there isn't one (or it can't be read).
+
+"""
+        try:
+            with open(self._file(key), 'rb') as f:
+                stored_key, value = pickle.load(f)
+        except (IOError, EOFError, pickle.UnpicklingError, ValueError):
+            return default
+        # in case of hash collisions
+        return value if stored_key == repr(key) else default
+
+    def put (self, key, value):
+        """Store a result, replacing any stored with the same key.
+
+put(key, value)
+
+"""
+        fd, tmp = mkstemp(dir = self.path)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                pickle.dump((repr(key), value), f, pickle.HIGHEST_PROTOCOL)
+            os.rename(tmp, self._file(key))
+        except:
+            os.remove(tmp)
+            raise
+
+    def remove (self, key):
+        """Remove a stored result, if there is one.
+
+remove(key)
+
+"""
+        try:
+            os.remove(self._file(key))
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+
+    def clear (self):
+        """Remove all stored results.
+
+clear()
+
+"""
+        for name in os.listdir(self.path):
+            if name.endswith('.pkl'):
+                os.remove(os.path.join(self.path, name))
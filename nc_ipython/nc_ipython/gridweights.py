@@ -0,0 +1,194 @@
+"""Area weights for rectilinear latitude/longitude grids, cached on disk.
+
+These are the weights cdms2 gives (from a variable's getGrid().getWeights()),
+computed with numpy alone from the latitude and longitude variables and their
+bounds, so that cdms2 needn't be imported to get them.  Weights are stored on
+disk keyed by the grid's coordinates, so that they're only worked out once for
+each grid.
+
+See the area_weights function.
+
+"""
+
+import os
+import threading
+from hashlib import sha1
+from tempfile import mkstemp
+
+import numpy
+import netCDF4
+
+_weights_dir = os.path.join(os.path.expanduser('~'), '.nc_ipython', 'weights')
+# grid signature: (lat_weights, lon_weights), as loaded from/saved to disk
+_weights = {}
+_lock = threading.Lock()
+
+
+def set_weights_dir (path):
+    """Set the directory area weights are stored in.
+
+set_weights_dir(path)
+
+path: the directory; it's created if needed.  If None, weights are only kept in
+      memory.  The default is ~/.nc_ipython/weights.
+
+"""
+    global _weights_dir
+    with _lock:
+        _weights_dir = path
+        _weights.clear()
+
+
+def axis_bounds (values, limits = None):
+    """Generate bounds for a coordinate axis, as cdms2 does.
+
+axis_bounds(values, limits = None) -> bounds
+
+values: 1D array of coordinate values.
+limits: (min, max) to clip the first and last cells' bounds to, such as
+        (-90, 90) for latitude.
+
+bounds: array with shape (len(values), 2), where each cell runs between the
+        midpoints of its value and its neighbours', and the end cells extend
+        as far past their values as to their neighbours' midpoints.  A single
+        value gets a cell of width 1 centred on it.
+
+This is cdms2's genGenericBounds, which cdms2 uses for the weights of a grid
+whose axes have no bounds.
+
+"""
+    values = numpy.asarray(values, float)
+    if len(values) == 1:
+        # no neighbours: cdms2 uses a width of 1
+        edges = numpy.array([values[0] - .5, values[0] + .5])
+    else:
+        edges = numpy.empty(len(values) + 1)
+        edges[1:-1] = (values[:-1] + values[1:]) / 2
+        edges[0] = 1.5 * values[0] - .5 * values[1]
+        edges[-1] = 1.5 * values[-1] - .5 * values[-2]
+    bounds = numpy.column_stack((edges[:-1], edges[1:]))
+    if limits is not None:
+        # only the end cells, as cdms2 does for latitude
+        for i in (0, -1):
+            bounds[i] = numpy.clip(bounds[i], min(limits), max(limits))
+    return bounds
+
+
+def _coordinates (dataset, name):
+    # values and bounds (None if the variable has none) of a coordinate
+    var = dataset.variables[name]
+    values = numpy.ma.filled(var[:], numpy.nan).astype(float)
+    bounds_name = getattr(var, 'bounds', None)
+    if bounds_name is not None and bounds_name in dataset.variables:
+        bounds = dataset.variables[bounds_name][:]
+        bounds = numpy.ma.filled(bounds, numpy.nan).astype(float)
+    else:
+        bounds = None
+    return (values, bounds)
+
+
+def _signature (lat, lat_bounds, lon, lon_bounds):
+    # key identifying a grid by its coordinates
+    h = sha1()
+    for a in (lat, lat_bounds, lon, lon_bounds):
+        if a is None:
+            h.update('\0none')
+        else:
+            h.update('\0{0}'.format(a.shape))
+            h.update(numpy.ascontiguousarray(a).tostring())
+    return h.hexdigest()
+
+
+def _weights_file (signature):
+    # path of the file weights are stored in
+    return os.path.join(_weights_dir, signature + '.npz')
+
+
+def _load_weights (signature):
+    # get weights from memory or disk, or None
+    if signature not in _weights and _weights_dir is not None:
+        try:
+            with numpy.load(_weights_file(signature)) as f:
+                _weights[signature] = (f['lat'], f['lon'])
+        except (IOError, KeyError, ValueError):
+            pass
+    return _weights.get(signature)
+
+
+def _save_weights (signature):
+    # write weights to disk, replacing atomically
+    if _weights_dir is None:
+        return
+    if not os.path.isdir(_weights_dir):
+        os.makedirs(_weights_dir)
+    fd, tmp = mkstemp(dir = _weights_dir)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            lat, lon = _weights[signature]
+            numpy.savez(f, lat = lat, lon = lon)
+        os.rename(tmp, _weights_file(signature))
+    except:
+        os.remove(tmp)
+        raise
+
+
+def grid_weights (lat, lon, lat_bounds = None, lon_bounds = None):
+    """Compute latitude and longitude area weights.
+
+grid_weights(lat, lon, lat_bounds = None, lon_bounds = None)
+    -> (lat_weights, lon_weights)
+
+lat, lon: 1D arrays of latitudes and longitudes, in degrees.
+lat_bounds, lon_bounds: corresponding arrays of cell bounds with shape (n, 2);
+                        if not given, they're generated by axis_bounds
+                        (latitude bounds are clipped to the poles).
+
+lat_weights: for each latitude, half the difference between the sines of its
+             bounds (so weights over the whole sphere sum to 1).
+lon_weights: for each longitude, the fraction of a circle between its bounds.
+
+"""
+    if lat_bounds is None:
+        lat_bounds = axis_bounds(lat, (-90, 90))
+    if lon_bounds is None:
+        lon_bounds = axis_bounds(lon)
+    lat_bounds = numpy.radians(lat_bounds)
+    lat_weights = .5 * numpy.absolute(numpy.sin(lat_bounds[:, 1]) -
+                                      numpy.sin(lat_bounds[:, 0]))
+    lon_weights = numpy.absolute(lon_bounds[:, 1] - lon_bounds[:, 0]) / 360.
+    return (lat_weights, lon_weights)
+
+
+def area_weights (dataset, lat_name = 'lat', lon_name = 'lon'):
+    """Get area weights for a dataset's latitude/longitude grid.
+
+area_weights(dataset, lat_name = 'lat', lon_name = 'lon') -> weights
+
+dataset: the path of a netCDF file, or an open netCDF4 (or ncserialisable)
+         Dataset.
+lat_name, lon_name: the names of the latitude and longitude variables.  Bounds
+                    are taken from the variables given by their bounds
+                    attributes, or generated if there are none (see
+                    grid_weights).
+
+weights: 2D array of weights with dimensions (lat, lon), as given by
+         numpy.outer(*var.getGrid().getWeights()) in cdms2.
+
+Weights are stored in the weights directory (see set_weights_dir), keyed by
+the coordinate values and bounds, so only need computing once for each grid.
+
+"""
+    if isinstance(dataset, basestring):
+        with netCDF4.Dataset(dataset) as d:
+            return area_weights(d, lat_name, lon_name)
+    lat, lat_bounds = _coordinates(dataset, lat_name)
+    lon, lon_bounds = _coordinates(dataset, lon_name)
+    signature = _signature(lat, lat_bounds, lon, lon_bounds)
+    with _lock:
+        weights = _load_weights(signature)
+        if weights is None:
+            _weights[signature] = grid_weights(lat, lon, lat_bounds,
+                                               lon_bounds)
+            _save_weights(signature)
+            weights = _weights[signature]
+    return numpy.outer(*weights)
@@ -0,0 +1,200 @@
+"""Write results over time to a CF netCDF file as they're computed.
+
+Results computed for a block of times at a time can be written to a file as
+each block is ready, so that the whole result is never in memory at once.  The
+time variable's metadata, and the coordinates of other dimensions (with their
+bounds), are copied from the variables the results are computed from.
+
+See the OutputFile class.
+
+"""
+
+import numpy
+import netCDF4
+
+# attributes that describe how values are stored, rather than what they are,
+# so aren't copied from source variables
+_storage_attrs = ('_FillValue', 'missing_value', 'scale_factor', 'add_offset',
+                  'valid_min', 'valid_max', 'valid_range', 'actual_range',
+                  'bounds')
+
+
+def _name (var):
+    # the name of a variable (MFDataset variables have no name attribute)
+    name = getattr(var, 'name', None)
+    return var._name if name is None else name
+
+
+def _copy_attrs (source, target):
+    # copy attributes of a variable (skipping storage attributes)
+    for name in source.ncattrs():
+        if name not in _storage_attrs:
+            target.setncattr(name, getattr(source, name))
+
+
+class OutputFile (object):
+    """A netCDF file that results over time are written to as they're ready.
+
+OutputFile(path, time, bounds = True, dtype = None, attrs = None,
+           format = 'NETCDF4')
+
+path: the path of the file to create; an existing file is replaced.
+time: the source time variable (netCDF4 or ncserialisable); its name, its
+      dimension's name and its attributes (such as units and calendar) are
+      copied.  The time dimension is unlimited in the file.
+bounds: whether to write time bounds, in a variable named '<time>_bnds'.
+dtype: the type of the time variable; defaults to that of the source.
+attrs: a dict of global attributes to set.  Conventions is set to 'CF-1.6'
+       unless given.
+format: as taken by netCDF4.Dataset.
+
+Add variables with add_variable, then write results for consecutive blocks of
+times with append.  Each block is written to disk as it's appended, so only
+the block being appended needs to be in memory.  Close the file with close, or
+use it as a context manager.
+
+"""
+
+    def __init__ (self, path, time, bounds = True, dtype = None,
+                  attrs = None, format = 'NETCDF4'):
+        self.path = path
+        self.n_times = 0
+        self._d = d = netCDF4.Dataset(path, 'w', format = format)
+        try:
+            d.setncattr('Conventions', 'CF-1.6')
+            for name, value in (attrs or {}).iteritems():
+                d.setncattr(name, value)
+            self._time_dim = time.dimensions[0]
+            d.createDimension(self._time_dim, None)
+            self._time = d.createVariable(
+                _name(time), time.dtype if dtype is None else dtype,
+                (self._time_dim,)
+            )
+            _copy_attrs(time, self._time)
+            if bounds:
+                if 'bnds' not in d.dimensions:
+                    d.createDimension('bnds', 2)
+                bounds_name = _name(time) + '_bnds'
+                self._bounds = d.createVariable(bounds_name, self._time.dtype,
+                                                (self._time_dim, 'bnds'))
+                self._time.setncattr('bounds', bounds_name)
+            else:
+                self._bounds = None
+        except:
+            d.close()
+            raise
+
+    def __enter__ (self):
+        return self
+
+    def __exit__ (self, *args):
+        self.close()
+
+    def _copy_coordinate (self, group, dim, size):
+        # create a dimension, and copy its coordinate variable and bounds
+        # from a source group if there are any
+        d = self._d
+        d.createDimension(dim, size)
+        if dim not in group.variables:
+            return
+        source = group.variables[dim]
+        if source.dimensions != (dim,):
+            return
+        coord = d.createVariable(dim, source.dtype, (dim,))
+        _copy_attrs(source, coord)
+        coord[:] = source[:]
+        bounds_name = getattr(source, 'bounds', None)
+        if bounds_name is None or bounds_name not in group.variables:
+            return
+        source_bounds = group.variables[bounds_name]
+        bounds_dims = source_bounds.dimensions
+        if len(bounds_dims) != 2 or bounds_dims[0] != dim:
+            return
+        if bounds_dims[1] not in d.dimensions:
+            d.createDimension(bounds_dims[1], source_bounds.shape[1])
+        bounds = d.createVariable(bounds_name, source_bounds.dtype,
+                                  bounds_dims)
+        _copy_attrs(source_bounds, bounds)
+        bounds[:] = source_bounds[:]
+        coord.setncattr('bounds', bounds_name)
+
+    def add_variable (self, name, source, dims = None, dtype = None,
+                      attrs = None):
+        """Add a variable to write results to.
+
+add_variable(name, source, dims = None, dtype = None, attrs = None)
+
+name: the name of the variable in the file.
+source: the variable the results are computed from (netCDF4 or
+        ncserialisable); its attributes are copied, except those describing
+        how values are stored.
+dims: the names of source's dimensions that results keep, in order; results
+      have time first, then these.  Dimensions and their coordinate variables
+      are copied from source's group when first used.  The default is all of
+      source's dimensions except time.
+dtype: the type of the results; defaults to that of source.
+attrs: a dict of attributes to set, after those copied from source.  A
+       cell_methods attribute is appended to any that source has.
+
+Values missing from results (masked) are stored as the default fill value for
+dtype.
+
+"""
+        if dims is None:
+            dims = [dim for dim in source.dimensions
+                    if dim != self._time_dim]
+        sizes = dict(zip(source.dimensions, source.shape))
+        group = source.group()
+        for dim in dims:
+            if dim not in self._d.dimensions:
+                self._copy_coordinate(group, dim, sizes[dim])
+        dtype = numpy.dtype(source.dtype if dtype is None else dtype)
+        fill_value = netCDF4.default_fillvals.get(dtype.str[1:])
+        var = self._d.createVariable(name, dtype,
+                                     (self._time_dim,) + tuple(dims),
+                                     fill_value = fill_value)
+        _copy_attrs(source, var)
+        for attr, value in (attrs or {}).iteritems():
+            if attr == 'cell_methods' and attr in var.ncattrs():
+                value = var.cell_methods + ' ' + value
+            var.setncattr(attr, value)
+
+    def append (self, times, values, bounds = None):
+        """Write results for the next block of times.
+
+append(times, values, bounds = None)
+
+times: array of the values of the time coordinate.
+values: a dict of arrays of results by variable name, each with time first.
+bounds: array of time bounds with shape (len(times), 2), if the file has
+        them.
+
+"""
+        n = len(times)
+        t0 = self.n_times
+        if n == 0:
+            return
+        self._time[t0:t0 + n] = times
+        if self._bounds is not None:
+            if bounds is None:
+                raise ValueError('time bounds must be given')
+            self._bounds[t0:t0 + n] = bounds
+        for name, value in values.iteritems():
+            self._d.variables[name][t0:t0 + n] = value
+        self.n_times += n
+
+    def sync (self):
+        """Write buffered data to disk.
+
+sync()
+
+"""
+        self._d.sync()
+
+    def close (self):
+        """Close the file.
+
+close()
+
+"""
+        self._d.close()
@@ -8,9 +8,25 @@ in netCDF4.  The only differences are (should be):
  * Some returned objects are replaced with wrappers from this module (for
    example, Dataset.variables contains Variable instead of netCDF4.Variable
    instances).
+ * Dataset.variables and the other dicts of objects are read-only mappings,
+   which return the same wrapper every time a key is looked up.  Use the
+   Dataset's create* and rename* methods to change them.
  * CompoundType and VLType instances have a group attribute
+ * Variable has a lazy attribute, for building serialisable references to
+   parts of it (see VariableSlice), methods describing its storage layout
+   (chunk_shape, file_bounds, partition) and a method for reading it in blocks
+   with read-ahead (iter_blocks; see also iter_variable_blocks)
 
-For notes on serialisation, see the documentation for Dataset.
+For notes on serialisation, see the documentation for Dataset.  Unserialised
+Datasets share open files through a pool; see set_pool_size.  They can also be
+made to open their files only when first used; see Dataset.set_lazy.
+
+Reads from chunked variables can be cached in memory; see set_block_cache.
+
+For a summary of the files in an MFDataset that doesn't need them all opening,
+see MFDataset.aggregation_index.
+
+To write to one file from several engines at once, see ParallelWriter.
 
 If you want to replace netCDF4 with this module, so that libraries that use it
 don't need to change their imports, then before importing them (but after
@@ -23,11 +39,364 @@ importing this module), do:
 
 import types
 import copy_reg
+import threading
+import fcntl
+from Queue import Queue, Full
+from bisect import bisect
+import sys
+import itertools
 from pickle import UnpicklingError
+from collections import Mapping
+from collections import OrderedDict as _OrderedDict
 
+import numpy
 import netCDF4
 from netCDF4 import * # provides OrderedDict
 
+
+class _WrapperDict (Mapping):
+    """A read-only mapping of wrappers around the objects in a netCDF4 dict.
+
+Takes the Dataset instance the objects belong to, the wrapper class and the
+netCDF4 dict (eg. netCDF4.Dataset.variables) to wrap.
+
+Wrappers are created the first time their key is looked up and the same
+instance is returned for every lookup after that.  Keys and ordering always
+come from the netCDF4 dict, so they follow any changes made to it.
+
+"""
+
+    def __init__ (self, group, cls, wrapped):
+        self._group = group
+        self._cls = cls
+        self._wrapped = wrapped
+        self._cache = {}
+
+    def __getitem__ (self, key):
+        try:
+            return self._cache[key]
+        except KeyError:
+            obj = self._cls(self._group, self._wrapped[key], key)
+            self._cache[key] = obj
+            return obj
+
+    def __contains__ (self, key):
+        return key in self._wrapped
+
+    def __iter__ (self):
+        return iter(self._wrapped)
+
+    def __len__ (self):
+        return len(self._wrapped)
+
+    def __repr__ (self):
+        return '{0}({1})'.format(self.__class__.__name__, list(self))
+
+    def _invalidate (self, wrapped, key = None, obj = None):
+        """Update after the netCDF4 dict has changed.
+
+_invalidate(wrapped[, key, obj])
+
+wrapped: the (possibly new) netCDF4 dict.
+key, obj: if given, use obj as the wrapper for key.
+
+Cached wrappers whose netCDF4 object is no longer in the dict are dropped.
+
+"""
+        self._wrapped = wrapped
+        for k, cached in self._cache.items():
+            if k not in wrapped or wrapped[k] is not cached._wrapped:
+                del self._cache[k]
+        if key is not None:
+            self._cache[key] = obj
+
+def _freeze (obj):
+    # turn constructor arguments into something hashable
+    if isinstance(obj, dict):
+        return tuple(sorted((k, _freeze(v)) for k, v in obj.iteritems()))
+    elif isinstance(obj, (list, tuple)):
+        return tuple(_freeze(x) for x in obj)
+    else:
+        return obj
+
+
+class _HandlePool (object):
+    """A pool of shared, reference-counted netCDF4 Dataset instances.
+
+_HandlePool(max_open = 64)
+
+max_open: the number of files to keep open.  Unused files are closed, least
+          recently used first, to stay within this.  Files that are in use are
+          never closed, so the pool can grow beyond this if they all are.
+
+"""
+
+    def __init__ (self, max_open = 64):
+        self.max_open = max_open
+        self._lock = threading.Lock()
+        # key: [dataset, n_references], least recently used first
+        self._handles = _OrderedDict()
+
+    def acquire (self, key, dataset_type, args, kwargs):
+        """Get an open dataset, adding a reference to it.
+
+acquire(key, dataset_type, args, kwargs) -> dataset
+
+key: identifies the dataset; should be as returned by _freeze.
+dataset_type, args, kwargs: used to open the dataset, if it isn't already
+                            open, as dataset_type(*args, **kwargs).
+
+"""
+        with self._lock:
+            entry = self._handles.pop(key, None)
+            if entry is None:
+                entry = [dataset_type(*args, **kwargs), 0]
+            entry[1] += 1
+            self._handles[key] = entry
+            self._evict()
+            return entry[0]
+
+    def release (self, key):
+        """Remove a reference added by acquire."""
+        with self._lock:
+            entry = self._handles.get(key)
+            if entry is not None and entry[1] > 0:
+                entry[1] -= 1
+            self._evict()
+
+    def clear (self):
+        """Close all unused datasets."""
+        with self._lock:
+            self._evict(0)
+
+    def _evict (self, max_open = None):
+        # close unused datasets until there are at most max_open open
+        if max_open is None:
+            max_open = self.max_open
+        excess = len(self._handles) - max_open
+        for key, (dataset, refs) in self._handles.items():
+            if excess <= 0:
+                break
+            if refs == 0:
+                del self._handles[key]
+                dataset.close()
+                excess -= 1
+
+
+_pool = _HandlePool()
+
+
+def set_pool_size (max_open):
+    """Set the maximum number of files kept open for unserialised Datasets.
+
+When a Dataset opened for reading is unserialised, it shares its underlying
+netCDF4.Dataset with any other unserialised Dataset in the process that was
+created with the same arguments, so unserialising the same Variable many times
+opens its file only once.  Closing one of these Datasets just releases its
+reference, and the file stays open for reuse until more than max_open files are
+open, when the least recently used unreferenced files are closed.
+
+The default is 64.
+
+"""
+    with _pool._lock:
+        _pool.max_open = max_open
+        _pool._evict()
+
+
+def clear_pool ():
+    """Close all files in the pool that aren't used by any open Dataset.
+
+Do this if files might have changed on disk since they were last opened.
+
+"""
+    _pool.clear()
+
+
+class _BlockCache (object):
+    """An LRU cache of arrays, limited by total size.
+
+_BlockCache(max_size = 0)
+
+max_size: the maximum total size of cached arrays in bytes.
+
+Keys are (base, chunk) tuples, where base identifies a variable: (files,
+path), with the absolute paths of the files it's read from and its path in
+them.  Arrays are stored as given, so they shouldn't be changed afterwards.
+
+"""
+
+    def __init__ (self, max_size = 0):
+        self.max_size = max_size
+        self.size = 0
+        self.hits = self.misses = self.evictions = 0
+        self._lock = threading.Lock()
+        # least recently used first
+        self._blocks = _OrderedDict()
+
+    def get (self, key):
+        """Get the array stored for key, or None."""
+        with self._lock:
+            data = self._blocks.pop(key, None)
+            if data is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self._blocks[key] = data
+            return data
+
+    def put (self, key, data):
+        """Store an array for key, if it fits."""
+        with self._lock:
+            old = self._blocks.pop(key, None)
+            if old is not None:
+                self.size -= old.nbytes
+            if data.nbytes <= self.max_size:
+                self._blocks[key] = data
+                self.size += data.nbytes
+            self._evict()
+
+    def discard (self, files, path = None):
+        """Remove all arrays stored for variables in any of some files.
+
+discard(files, path = None)
+
+files: absolute paths of files, as in the first item of a base.
+path: if given, only remove arrays for the variable with this path (the second
+      item of a base).
+
+"""
+        files = set(files)
+        with self._lock:
+            for key in [k for k in self._blocks
+                        if (path is None or k[0][1] == path) and
+                        not files.isdisjoint(k[0][0])]:
+                self.size -= self._blocks.pop(key).nbytes
+
+    def clear (self):
+        with self._lock:
+            self._blocks.clear()
+            self.size = 0
+
+    def _evict (self):
+        while self.size > self.max_size:
+            key, data = self._blocks.popitem(False)
+            self.size -= data.nbytes
+            self.evictions += 1
+
+
+_block_cache = _BlockCache()
+
+
+def set_block_cache (max_size):
+    """Set the amount of memory to use for caching reads from Variables.
+
+set_block_cache(max_size)
+
+max_size: the maximum total size of cached data, in bytes; 0 (the default)
+          disables the cache.
+
+When enabled, a read from a chunked Variable (Variable.__getitem__ with only
+ints, slices and Ellipsis) reads whole chunks and keeps them, after
+decompression, for later reads of overlapping data.  The cache is shared by all
+Variables in the process, and keys chunks on the absolute paths of the
+file(s), the variable and the chunk index, so it works across separately
+opened or unserialised Datasets and MFDatasets.  The least recently used
+chunks are dropped to stay within max_size.  Writing to a Variable through
+Variable.__setitem__ drops the chunks cached for that variable by every
+Dataset or MFDataset reading the file, and writing through a ParallelWriter
+drops those for every variable in the file.
+
+Note that changes to files made elsewhere, including by other processes (such
+as other engines writing with a ParallelWriter), aren't noticed; call
+clear_block_cache if this might happen.
+
+See also block_cache_stats.
+
+"""
+    with _block_cache._lock:
+        _block_cache.max_size = max_size
+        _block_cache._evict()
+
+
+def clear_block_cache ():
+    """Drop everything from the cache set up by set_block_cache."""
+    _block_cache.clear()
+
+
+def block_cache_stats (reset = False):
+    """Get statistics for the cache set up by set_block_cache.
+
+block_cache_stats(reset = False) -> stats
+
+reset: whether to reset the counters to 0 afterwards.
+
+stats: a dict with keys:
+    hits, misses: the number of chunks found and not found in the cache.
+    evictions: the number of chunks dropped to make space.
+    size: the total size of cached chunks in bytes.
+    max_size: as passed to set_block_cache.
+    blocks: the number of cached chunks.
+
+"""
+    c = _block_cache
+    with c._lock:
+        stats = {'hits': c.hits, 'misses': c.misses,
+                 'evictions': c.evictions, 'size': c.size,
+                 'max_size': c.max_size, 'blocks': len(c._blocks)}
+        if reset:
+            c.hits = c.misses = c.evictions = 0
+    return stats
+
+
+class _Deferred (object):
+    """Stands in for a netCDF4 object in a lazily unserialised Dataset.
+
+Takes the root Dataset, the Dataset or Group the object is in, and the attr and
+key the object is found through (see Dataset._want_wrapped).
+
+When first used, this opens the root Dataset, which replaces it with the real
+object wherever it was requested, and passes the use on to the real object.
+
+"""
+
+    _own_attrs = ('_root', '_dataset', '_attr', '_key')
+
+    def __init__ (self, root, dataset, attr, key):
+        self.__dict__.update(_root = root, _dataset = dataset, _attr = attr,
+                             _key = key)
+
+    def _resolve (self):
+        self._root._open()
+        return getattr(self._dataset._wrapped, self._attr)[self._key]
+
+    def __str__ (self):
+        return str(self._resolve())
+
+    def __unicode__ (self):
+        return unicode(self._resolve())
+
+    def __delattr__ (self, attr):
+        delattr(self._resolve(), attr)
+
+    def __getattr__ (self, attr):
+        if attr in self._own_attrs:
+            raise AttributeError(attr)
+        return getattr(self._resolve(), attr)
+
+    def __setattr__ (self, attr, val):
+        setattr(self._resolve(), attr, val)
+
+    def __getitem__ (self, index):
+        return self._resolve()[index]
+
+    def __setitem__ (self, index, val):
+        self._resolve()[index] = val
+
+    def __len__ (self):
+        return len(self._resolve())
+
+
 class CompoundType (object):
     """A netCDF4.CompoundType wrapper that can be serialised.
 
@@ -84,6 +453,13 @@ as in the serialising environment.
 It is possible to pass a closed instance for serialisation, and the
 unserialised instance will still be open.
 
+Unserialised instances in read mode share open files with each other (not with
+instances created directly); closing one releases the file rather than closing
+it.  See set_pool_size.
+
+To avoid opening the file until it's needed, call set_lazy before serialising,
+or create the instance with deferred.
+
 Note that, for example, serialising and retrieving a Dataset and one of its
 Variable instances will yield a Dataset and Variable that are no longer
 connected.  Instead, do this with only one object in the hierarchy and retrieve
@@ -100,7 +476,8 @@ Diskless operation is not supported.
 """
 
     _private_attrs = (
-        '_args', '_kwargs', '_wrapped', '_want_wrappeds'
+        '_args', '_kwargs', '_wrapped', '_want_wrappeds', '_wrappers',
+        '_pool_key', '_lazy', '_deferred', '_paths'
     )
     _public_attrs = (
         'parent',
@@ -117,10 +494,18 @@ Diskless operation is not supported.
     def _init_dataset (self, args, kwargs, reopen = False):
         self._args = args
         self._kwargs = kwargs
+        self._wrappers = {}
+        mode = self._mode(args, kwargs)
         if reopen:
+            if mode == 'r':
+                # share the file with other unserialised instances
+                self._pool_key = key = _freeze((self._dataset_type, args,
+                                                kwargs))
+                self._wrapped = _pool.acquire(key, self._dataset_type, args,
+                                              kwargs)
+                return
             # if mode is write, don't allow reclobbering or raising an
             # exception: switch to append
-            mode = args[1] if len(args) >= 2 else kwargs.get('mode', 'r')
             if mode in ('w', 'ws'):
                 mode = mode.replace('w', 'a')
                 if len(args) >= 2:
@@ -130,6 +515,19 @@ Diskless operation is not supported.
                     kwargs['mode'] = mode
         self._wrapped = d = self._dataset_type(*args, **kwargs)
 
+    def _mode (self, args, kwargs):
+        # get the mode from arguments to netCDF4.Dataset
+        return args[1] if len(args) >= 2 else kwargs.get('mode', 'r')
+
+    def _files (self):
+        # absolute paths of the files opened, as a tuple; worked out once
+        paths = self.__dict__.get('_paths')
+        if paths is None:
+            from nc_ipython.aggregation import resolve_files
+            files = self._args[0] if self._args else self._kwargs['filename']
+            self._paths = paths = tuple(resolve_files([files]))
+        return paths
+
     # magic wrappers
 
     def __enter__ (self):
@@ -152,18 +550,23 @@ Diskless operation is not supported.
             delattr(self._wrapped, attr)
 
     def __getattr__ (self, attr):
+        if attr == '_wrapped' and self.__dict__.get('_deferred'):
+            # lazily unserialised: open now
+            self._open()
+            return self.__dict__['_wrapped']
+        if attr in self._private_attrs:
+            # not set yet: don't look for it in the wrapped object
+            raise AttributeError(attr)
         val = getattr(self._wrapped, attr)
         # replace object dicts with dicts of wrappers
-        cls = {
-            'cmptypes': CompoundType,
-            'dimensions': Dimension,
-            'groups': Group,
-            'vltypes': VLType,
-            'variables': Variable
-        }.get(attr, None)
-        if cls is not None:
-            return OrderedDict((k, cls(self, v, k)) \
-                               for k, v in val.iteritems())
+        cls = _wrapper_classes.get(attr, None)
+        if cls is None:
+            return val
+        # keep the same wrappers around between lookups
+        wrappers = self.__dict__.setdefault('_wrappers', {})
+        if attr not in wrappers:
+            wrappers[attr] = _WrapperDict(self, cls, val)
+        return wrappers[attr]
 
     def __setattr__ (self, attr, val):
         if attr in self._private_attrs + self._public_attrs:
@@ -177,7 +580,52 @@ Diskless operation is not supported.
         # everything can be reconstructed from args to netCDF4.Dataset, plus
         # some public attributes we want to preserve
         attrs = dict((k, getattr(self, k)) for k in self._public_attrs)
-        return (self._args, self._kwargs, attrs)
+        return (self._args, self._kwargs, attrs,
+                self.__dict__.get('_lazy', False))
+
+    def set_lazy (self, lazy = True):
+        """Set whether unserialised copies open the file only when first used.
+
+set_lazy(lazy = True)
+
+When lazy, unserialising this instance (or any object in it) doesn't touch the
+file.  It's opened the first time data or metadata is needed from the
+unserialised instance or any object retrieved through it, so engines that never
+use it don't open it at all.  Errors opening the file or finding objects in it
+are raised at that point rather than on unserialisation.
+
+This affects the whole file, so calling it on a Group sets it for the Dataset.
+
+"""
+        if self.parent is None:
+            self._lazy = lazy
+        else:
+            self.parent.set_lazy(lazy)
+
+    @classmethod
+    def deferred (cls, *args, **kwargs):
+        """Create an instance that opens the file only when first used.
+
+deferred(*args, **kwargs) -> dataset
+
+Takes the same arguments as the constructor, for read mode only.  The result
+is like a lazily unserialised instance (see set_lazy): nothing is opened until
+data or metadata is needed, and unserialised copies are lazy and share open
+files with each other.  This is useful for sending to engines without opening
+the file in the client.
+
+"""
+        self = cls.__new__(cls)
+        if self._mode(args, kwargs) != 'r':
+            raise ValueError('only read mode is supported')
+        self.__setstate__((args, kwargs, {'parent': None}, True))
+        return self
+
+    def _open (self):
+        """Open the file if it was left closed by lazy unserialisation."""
+        if self.__dict__.pop('_deferred', False):
+            self._init_dataset(self._args, self._kwargs, True)
+            self._resolve_wanted()
 
     def _want_wrapped (self, attr, key, instance, dataset = None):
         """Signal the Dataset that a netCDF4 object to wrap is needed.
@@ -198,11 +646,17 @@ dataset: the Dataset instance to obtain ndataset from; defaults to this
 
 wrapped: the object, if it can be obtained now.  If this instance has not yet
          been initialised, this is None, and instance._wrapped will be done
-         later (before this instance's unserialisation finishes).
+         later (before this instance's unserialisation finishes).  If this
+         instance was lazily unserialised (see set_lazy), this is a _Deferred
+         instance, and instance._wrapped will be done when the file is opened.
 
 """
         if dataset is None:
             dataset = self
+        if self.__dict__.get('_deferred'):
+            # lazy: store a request and resolve it on opening
+            self._store_want(dataset, attr, key, instance)
+            return _Deferred(self, dataset, attr, key)
         if hasattr(dataset, '_wrapped'):
             # obtain and return the object now
             try:
@@ -213,21 +667,35 @@ wrapped: the object, if it can be obtained now.  If this instance has not yet
                 raise UnpicklingError(err.format(attr[:-1], key, dataset.path))
         else:
             # not initialised yet: store a request
-            if not hasattr(self, '_want_wrappeds'):
-                self._want_wrappeds = {}
-            if (dataset, attr) in self._want_wrappeds:
-                self._want_wrappeds[(dataset, attr)].append((key, instance))
-            else:
-                self._want_wrappeds[(dataset, attr)] = [(key, instance)]
+            self._store_want(dataset, attr, key, instance)
+
+    def _store_want (self, dataset, attr, key, instance):
+        # store a request for _resolve_wanted to handle
+        if not hasattr(self, '_want_wrappeds'):
+            self._want_wrappeds = {}
+        if (dataset, attr) in self._want_wrappeds:
+            self._want_wrappeds[(dataset, attr)].append((key, instance))
+        else:
+            self._want_wrappeds[(dataset, attr)] = [(key, instance)]
 
     def __setstate__ (self, state):
-        args, kwargs, attrs = state
-        self._init_dataset(args, kwargs, True)
+        args, kwargs, attrs, lazy = state
         self.__dict__.update(attrs)
+        if lazy:
+            # wait until needed to open (see _open)
+            self._args = args
+            self._kwargs = kwargs
+            self._lazy = True
+            self._deferred = True
+        else:
+            self._init_dataset(args, kwargs, True)
+            self._resolve_wanted()
+
+    def _resolve_wanted (self):
         # handle wrapped requests (see _want_wrapped)
         if hasattr(self, '_want_wrappeds'):
             for (dataset, attr), wanting in self._want_wrappeds.iteritems():
-                wrappeds = getattr(dataset, attr)
+                wrappeds = getattr(dataset._wrapped, attr)
                 for key, instance in wanting:
                     try:
                         instance._wrapped = wrappeds[key]
@@ -238,34 +706,88 @@ wrapped: the object, if it can be obtained now.  If this instance has not yet
                         raise UnpicklingError(err)
             del self._want_wrappeds
 
+    def _invalidate_wrappers (self, attr, key = None, obj = None):
+        # update the wrapper dict for attr after a change
+        getattr(self, attr)._invalidate(getattr(self._wrapped, attr), key, obj)
+
     # method wrappers
 
     def close (self):
-        self._wrapped.close()
+        if self.__dict__.pop('_deferred', False):
+            # lazily unserialised and never opened
+            return
+        key = self.__dict__.get('_pool_key')
+        if key is None:
+            self._wrapped.close()
+        elif key is not False:
+            # shared: release the file rather than closing it (once only)
+            self._pool_key = False
+            _pool.release(key)
 
     def createCompoundType (self, datatype, datatype_name):
         c = self._wrapped.createCompoundType(datatype, datatype_name)
-        return CompoundType(self, c, datatype_name)
+        c = CompoundType(self, c, datatype_name)
+        self._invalidate_wrappers('cmptypes', datatype_name, c)
+        return c
 
     def createDimension (self, dimname, size = None):
         d = self._wrapped.createDimension(dimname, size)
-        return Dimension(self, d, dimname)
+        d = Dimension(self, d, dimname)
+        self._invalidate_wrappers('dimensions', dimname, d)
+        return d
 
     def createGroup (self, groupname):
         g = self._wrapped.createGroup(groupname)
-        return Group(self, g, groupname)
+        g = Group(self, g, groupname)
+        self._invalidate_wrappers('groups', groupname, g)
+        return g
 
     def createVLType (self, datatype, datatype_name):
         v = self._wrapped.createVLType(datatype, datatype_name)
-        return VLType(self, v, datatype_name)
+        v = VLType(self, v, datatype_name)
+        self._invalidate_wrappers('vltypes', datatype_name, v)
+        return v
 
     def createVariable (self, varname, datatype, *args, **kwargs):
         if isinstance(datatype, (CompoundType, VLType)):
             # netCDF4.Variable constructor expects a netCDF4.CompoundType or
             # netCDF4.VLType subclass, not CompoundType or VLType
+            datatype.group._open()
             datatype = datatype._wrapped
         v = self._wrapped.createVariable(varname, datatype, *args, **kwargs)
-        return Variable(self, v, varname)
+        v = Variable(self, v, varname)
+        self._invalidate_wrappers('variables', varname, v)
+        return v
+
+    def parallel_writer (self):
+        """Close the file and get a ParallelWriter for it.
+
+parallel_writer() -> writer
+
+Call this on a Dataset opened for writing, after creating its dimensions,
+variables and attributes.  This instance (and everything retrieved through it)
+can't be used afterwards.
+
+"""
+        if self.parent is not None:
+            return self.parent.parallel_writer()
+        if self._mode(self._args, self._kwargs) == 'r':
+            raise ValueError('dataset isn\'t open for writing')
+        self.close()
+        return ParallelWriter(self._args[0] if self._args
+                              else self._kwargs['filename'])
+
+    def renameDimension (self, oldname, newname):
+        self._wrapped.renameDimension(oldname, newname)
+        self._invalidate_wrappers('dimensions')
+
+    def renameGroup (self, oldname, newname):
+        self._wrapped.renameGroup(oldname, newname)
+        self._invalidate_wrappers('groups')
+
+    def renameVariable (self, oldname, newname):
+        self._wrapped.renameVariable(oldname, newname)
+        self._invalidate_wrappers('variables')
 
 
 class MFDataset (Dataset):
@@ -279,6 +801,33 @@ See Dataset for serialisation details.
 
     _dataset_type = netCDF4.MFDataset
 
+    def _mode (self, args, kwargs):
+        # always read-only
+        return 'r'
+
+    def _files (self):
+        # as for Dataset
+        paths = self.__dict__.get('_paths')
+        if paths is None:
+            from nc_ipython.aggregation import resolve_files
+            files = self._args[0] if self._args else self._kwargs['files']
+            self._paths = paths = tuple(resolve_files(files))
+        return paths
+
+    def aggregation_index (self, time_name = 'time'):
+        """Get the nc_ipython.aggregation.AggregationIndex for the files.
+
+aggregation_index(time_name = 'time') -> index
+
+time_name: as taken by nc_ipython.aggregation.aggregation_index.
+
+For a lazily unserialised instance, this doesn't open the files.
+
+"""
+        from nc_ipython.aggregation import aggregation_index
+        files = self._args[0] if self._args else self._kwargs['files']
+        return aggregation_index(files, time_name)
+
 
 class Dimension (object):
     """A netCDF4.Dimension wrapper that can be serialised.
@@ -349,6 +898,9 @@ Like with netCDF4.Group, you shouldn't create one of these directly.
             group = self
         return self.parent._want_wrapped(attr, key, instance, group)
 
+    def _open (self):
+        self.parent._open()
+
     def __getstate__ (self):
         return (self.parent, self._name)
 
@@ -439,9 +991,15 @@ Like with netCDF4.Variable, you shouldn't create one of these directly.
             setattr(self._wrapped, attr, val)
 
     def __getitem__ (self, index):
+        if _block_cache.max_size > 0:
+            data = self._read_cached(index)
+            if data is not None:
+                return data
         return self._wrapped[index]
 
     def __setitem__ (self, index, val):
+        if _block_cache.max_size > 0:
+            _block_cache.discard(*self._cache_base())
         self._wrapped[index] = val
 
     def __len__ (self):
@@ -457,7 +1015,752 @@ Like with netCDF4.Variable, you shouldn't create one of these directly.
         variable = group._want_wrapped('variables', name, self)
         self.__init__(group, variable, name)
 
+    # caching (see set_block_cache)
+
+    def _cache_base (self):
+        # identifies this variable in the cache: absolute paths of the
+        # file(s) and path in the file
+        path = [self._name]
+        group = self._group
+        while group.parent is not None:
+            path.append(group._name)
+            group = group.parent
+        return (group._files(), tuple(reversed(path)))
+
+    def _read_cached (self, index):
+        # read through the block cache; returns None if this can't be done
+        bounds = [self._chunk_bounds(axis) for axis in xrange(len(self.shape))]
+        if not bounds or bounds[0] is None:
+            return None
+        ranges = _index_ranges(index, self.shape)
+        if ranges is None:
+            return None
+        # for each dimension: requested positions and the chunks they're in
+        positions = []
+        chunk_ids = []
+        for r, b in zip(ranges, bounds):
+            if isinstance(r, (int, long)):
+                pos = numpy.array([r])
+            else:
+                pos = numpy.arange(*r)
+            positions.append(pos)
+            chunk_ids.append(numpy.searchsorted(b, pos, 'right') - 1)
+        shape = tuple(len(pos) for pos in positions)
+        if 0 in shape:
+            return None
+        base = self._cache_base()
+        wanted = list(itertools.product(*[numpy.unique(ids)
+                                          for ids in chunk_ids]))
+        blocks = dict((c, _block_cache.get((base, c))) for c in wanted)
+        missing = [c for c in wanted if blocks[c] is None]
+        lo = [min(ids) for ids in zip(*wanted)]
+        hi = [max(ids) + 1 for ids in zip(*wanted)]
+        box_size = numpy.prod([h - l for l, h in zip(lo, hi)])
+        if missing and len(missing) == len(wanted) and \
+           box_size <= 2 * len(wanted):
+            # read everything at once, then split into chunks; not for
+            # strided or sparse selections, where the box covering the
+            # wanted chunks is mostly chunks that aren't wanted
+            box = self._wrapped[tuple(slice(b[l], b[h])
+                                      for b, l, h in zip(bounds, lo, hi))]
+            for c in wanted:
+                blocks[c] = box[tuple(
+                    slice(b[i] - b[l], b[i + 1] - b[l])
+                    for b, i, l in zip(bounds, c, lo)
+                )].copy()
+                _block_cache.put((base, c), blocks[c])
+        else:
+            for c in missing:
+                blocks[c] = self._wrapped[tuple(slice(b[i], b[i + 1])
+                                                for b, i in zip(bounds, c))]
+                _block_cache.put((base, c), blocks[c])
+        # assemble result
+        dtype = blocks[wanted[0]].dtype
+        if any(isinstance(b, numpy.ma.MaskedArray) for b in blocks.values()):
+            data = numpy.ma.masked_array(numpy.empty(shape, dtype),
+                                         numpy.zeros(shape, bool))
+        else:
+            data = numpy.empty(shape, dtype)
+        for c in wanted:
+            sel = [ids == i for ids, i in zip(chunk_ids, c)]
+            out_index = numpy.ix_(*[numpy.flatnonzero(s) for s in sel])
+            in_index = numpy.ix_(*[pos[s] - b[i] for pos, s, b, i in
+                                   zip(positions, sel, bounds, c)])
+            data[out_index] = blocks[c][in_index]
+        # drop dimensions that were indexed with ints
+        return data[tuple(0 if isinstance(r, (int, long)) else slice(None)
+                          for r in ranges)]
+
+    # extra methods
+
+    @property
+    def lazy (self):
+        """A VariableSlice covering the whole variable.
+
+Index this to get a reference to part of the variable without reading it, eg.
+var.lazy[0:10, ...].mean(0).
+
+"""
+        return VariableSlice(self)
+
+    def chunk_shape (self):
+        """Get the shape of the chunks the variable is stored in.
+
+chunk_shape() -> shape
+
+shape: a tuple giving the chunk size along each dimension, or None if the
+       variable is stored contiguously.  For a variable in an MFDataset, this
+       is for the first file.
+
+"""
+        v = getattr(self._wrapped, '_mastervar', self._wrapped)
+        chunks = v.chunking()
+        if chunks == 'contiguous':
+            return None
+        return tuple(chunks)
+
+    def file_bounds (self):
+        """Get the indices where each file starts in an MFDataset variable.
+
+file_bounds() -> bounds
+
+bounds: a list of indices along the first (aggregated) dimension, starting with
+        0 and ending with the variable's length, where consecutive items give
+        the part stored in each file, as bounds[i]:bounds[i + 1].  If the
+        variable is not split over files, this is [0, length].
+
+"""
+        lengths = getattr(self._wrapped, '_recLen', None)
+        if lengths is None:
+            return [0, len(self._wrapped)]
+        bounds = [0]
+        for l in lengths:
+            bounds.append(bounds[-1] + l)
+        return bounds
+
+    def _chunk_bounds (self, axis):
+        # indices where chunks start along a dimension, plus its length; None
+        # if contiguous
+        chunks = self.chunk_shape()
+        if chunks is None:
+            return None
+        if axis == 0:
+            files = self.file_bounds()
+        else:
+            files = [0, self.shape[axis]]
+        bounds = []
+        for f0, f1 in zip(files[:-1], files[1:]):
+            bounds.extend(xrange(f0, f1, chunks[axis]))
+        bounds.append(files[-1])
+        return bounds
+
+    def partition (self, n_pieces, axis = 0, start = 0, end = None):
+        """Split a range along a dimension into pieces that suit the storage.
+
+partition(n_pieces, axis = 0, start = 0, end = None) -> list_of_ranges
+
+n_pieces: the number of pieces to aim for.
+axis: the index of the dimension to split.
+start, end: the range to split; end defaults to the dimension's length.
+
+list_of_ranges: a list of (start, end) tuples, as returned by
+                globalmean.split_range.
+
+This is like splitting into equal pieces, but each split point is moved to the
+nearest file boundary (see file_bounds), or failing that the nearest chunk
+boundary (see chunk_shape), as long as that's less than half a piece away.
+Reads of the resulting pieces don't share chunks or files as far as possible.
+
+"""
+        if end is None:
+            end = self.shape[axis]
+        # boundaries that splits would ideally be moved to
+        if axis == 0:
+            files = self.file_bounds()
+        else:
+            files = [0, self.shape[axis]]
+        chunk_bounds = self._chunk_bounds(axis) or []
+        return _partition(n_pieces, start, end, (files, chunk_bounds))
+
+    def iter_blocks (self, block_size, axis = 0, start = 0, end = None,
+                     index = None, prefetch = 2):
+        """Read the variable in blocks along a dimension, reading ahead.
+
+iter_blocks(block_size, axis = 0, start = 0, end = None, index = None,
+            prefetch = 2) -> iterator
+
+block_size: the number of items along the dimension to aim for in each block.
+            Blocks are split using partition, so may vary a little.
+axis: the index of the dimension to read along.
+start, end: the range to read along the dimension; end defaults to the
+            dimension's length.
+index: an index to read with (as taken by __getitem__), with an item for every
+       dimension; the item for axis is replaced for each block.  The default
+       is to read everything.
+prefetch: the number of blocks to read ahead.  If this is 0, no reading is done
+          in the background.
+
+iterator: yields (block_start, block_end, data) for each block in order.
+
+Blocks are read by a background thread while the caller works on the previous
+block, up to prefetch blocks ahead, so at most prefetch + 2 blocks are held at
+once.  The netCDF library isn't thread-safe, so don't use this Dataset (or
+any other) from another thread while iterating.  If you stop iterating before
+the end (including through an exception), call the iterator's close method
+(or use contextlib.closing) before using any Dataset again, so that the
+background thread has stopped.
+
+"""
+        if end is None:
+            end = self.shape[axis]
+        n_pieces = (end - start + block_size - 1) // block_size
+        ranges = self.partition(n_pieces, axis, start, end)
+        if index is None:
+            index = [slice(None)] * len(self.shape)
+        index = list(index)
+
+        def read (b0, b1):
+            index[axis] = slice(b0, b1)
+            return (b0, b1, self[tuple(index)])
+
+        return _iter_prefetch(read, ranges, prefetch)
+
     # method wrappers
 
     def group (self):
-        return self._group
\ No newline at end of file
+        return self._group
+
+
+def iter_variable_blocks (variables, block_size, axes = 0, start = 0,
+                          end = None, indices = None, prefetch = 2):
+    """Read several variables in blocks along a dimension, reading ahead.
+
+iter_variable_blocks(variables, block_size, axes = 0, start = 0, end = None,
+                     indices = None, prefetch = 2) -> iterator
+
+variables: a list of Variable instances.
+axes: the index of the dimension to read along in each variable: a list, or a
+      single index for all of them.
+indices: a list of indices to read each variable with, as taken by
+         Variable.iter_blocks; an item may be None to read everything.
+         Defaults to reading everything from every variable.
+
+Other arguments are as taken by Variable.iter_blocks, and blocks are split to
+suit the storage of the first variable.
+
+iterator: yields (block_start, block_end, data) for each block in order, where
+          data is a list of the block of each variable.
+
+This is like Variable.iter_blocks for each variable together, but reads in just
+one background thread (as the netCDF library isn't thread-safe).
+
+"""
+    n = len(variables)
+    if isinstance(axes, (int, long)):
+        axes = [axes] * n
+    if indices is None:
+        indices = [None] * n
+    indices = [[slice(None)] * len(v.shape) if index is None else list(index)
+               for v, index in zip(variables, indices)]
+    if end is None:
+        end = variables[0].shape[axes[0]]
+    n_pieces = (end - start + block_size - 1) // block_size
+    ranges = variables[0].partition(n_pieces, axes[0], start, end)
+
+    def read (b0, b1):
+        data = []
+        for v, axis, index in zip(variables, axes, indices):
+            index[axis] = slice(b0, b1)
+            data.append(v[tuple(index)])
+        return (b0, b1, data)
+
+    return _iter_prefetch(read, ranges, prefetch)
+
+
+def _iter_prefetch (read, ranges, prefetch):
+    # iterate over read(*r) for r in ranges, reading in a thread up to
+    # prefetch ahead (see Variable.iter_blocks)
+    if prefetch <= 0:
+        return (read(*r) for r in ranges)
+    else:
+        return _iter_thread(read, ranges, prefetch)
+
+
+def _iter_thread (read, ranges, prefetch):
+    # generator for _iter_prefetch
+    queue = Queue(prefetch)
+    stop = threading.Event()
+
+    def put (item):
+        # returns False if the caller has stopped iterating
+        while not stop.is_set():
+            try:
+                queue.put(item, timeout = .1)
+                return True
+            except Full:
+                pass
+        return False
+
+    def reader ():
+        # pass on any error, so the caller never waits for a block that
+        # isn't coming
+        try:
+            for r in ranges:
+                if stop.is_set() or not put((True, read(*r))):
+                    return
+        except:
+            put((False, sys.exc_info()))
+
+    thread = threading.Thread(target = reader)
+    thread.daemon = True
+    thread.start()
+    try:
+        for i in xrange(len(ranges)):
+            ok, item = queue.get()
+            if not ok:
+                raise item[0], item[1], item[2]
+            yield item
+    finally:
+        # stop reading if the caller finishes early or raises, and wait for
+        # the thread to finish, so the file isn't used from two threads
+        stop.set()
+        thread.join()
+
+
+def _partition (n_pieces, start, end, boundaries):
+    """Split a range into pieces, with splits moved to preferred boundaries.
+
+_partition(n_pieces, start, end, boundaries) -> list_of_ranges
+
+boundaries: a sequence of sorted lists of indices, most preferred first.  Each
+            split is moved to the nearest index in the first list that has one
+            less than half a piece away.
+
+See Variable.partition.
+
+"""
+    n = end - start
+    if n <= 0:
+        return []
+    per_piece = float(n) / n_pieces
+    pieces = [start]
+    for i in xrange(1, n_pieces):
+        ideal = start + per_piece * i
+        split = int(round(ideal))
+        for bounds in boundaries:
+            # nearest boundary
+            j = bisect(bounds, ideal)
+            near = [b for b in bounds[max(j - 1, 0):j + 1]
+                    if start < b < end]
+            if near:
+                b = min(near, key = lambda b: abs(b - ideal))
+                if abs(b - ideal) < per_piece / 2.:
+                    split = b
+                    break
+        pieces.append(split)
+    pieces.append(end)
+    return [(p0, p1) for p0, p1 in zip(pieces[:-1], pieces[1:]) if p0 < p1]
+
+
+# indexing
+
+def _index_ranges (index, shape):
+    """Normalise a basic index into one range per dimension.
+
+_index_ranges(index, shape) -> ranges
+
+index: as taken by Variable.__getitem__.
+shape: the shape of the indexed array.
+
+ranges: a tuple with an item for each dimension in shape: an int for an index
+        (which drops the dimension) or a (start, stop, step) tuple, as returned
+        by slice.indices (but (0, 0, 1) if empty).  This is None if index
+        contains anything other than ints, slices and a single Ellipsis.
+
+"""
+    if not isinstance(index, tuple):
+        index = (index,)
+    n_ellipsis = 0
+    for i in index:
+        if i is Ellipsis:
+            n_ellipsis += 1
+        elif isinstance(i, bool) or \
+             not isinstance(i, (slice, int, long, numpy.integer)):
+            return None
+    n_fill = len(shape) - len(index) + n_ellipsis
+    if n_ellipsis > 1 or n_fill < 0:
+        return None
+    # expand Ellipsis and trailing dimensions
+    full = []
+    for i in index:
+        if i is Ellipsis:
+            full += [slice(None)] * n_fill
+            n_fill = 0
+        else:
+            full.append(i)
+    full += [slice(None)] * n_fill
+    ranges = []
+    for i, n in zip(full, shape):
+        if isinstance(i, slice):
+            r = i.indices(n)
+            ranges.append(r if len(xrange(*r)) else (0, 0, 1))
+        else:
+            i = int(i)
+            if i < 0:
+                i += n
+            if not 0 <= i < n:
+                raise IndexError('index out of range')
+            ranges.append(i)
+    return tuple(ranges)
+
+
+def _compose_ranges (ranges, index):
+    """Apply an index to the result of indexing with some ranges.
+
+_compose_ranges(ranges, index) -> new_ranges
+
+ranges: as returned by _index_ranges.
+index: as taken by Variable.__getitem__, applying to the array obtained by
+       indexing with ranges.
+
+new_ranges: ranges that give the same result as indexing with ranges and then
+            index, or None if index isn't basic (see _index_ranges).
+
+"""
+    kept = [r for r in ranges if not isinstance(r, (int, long))]
+    sizes = [len(xrange(*r)) for r in kept]
+    sub = _index_ranges(index, sizes)
+    if sub is None:
+        return None
+    sub = iter(sub)
+    new_ranges = []
+    for r in ranges:
+        if isinstance(r, (int, long)):
+            new_ranges.append(r)
+            continue
+        start, stop, step = r
+        s = next(sub)
+        if isinstance(s, (int, long)):
+            new_ranges.append(start + s * step)
+        else:
+            n = len(xrange(*s))
+            if n:
+                start += s[0] * step
+                step *= s[2]
+                new_ranges.append((start, start + n * step, step))
+            else:
+                new_ranges.append((0, 0, 1))
+    return tuple(new_ranges)
+
+
+def _ranges_index (ranges):
+    """Turn the result of _index_ranges back into an index."""
+    index = []
+    for r in ranges:
+        if isinstance(r, (int, long)):
+            index.append(r)
+        else:
+            start, stop, step = r
+            if stop < 0:
+                # from a negative step: run to the start
+                stop = None
+            index.append(slice(start, stop, step))
+    return tuple(index)
+
+
+class VariableSlice (object):
+    """A lazy reference to part of a Variable that can be serialised.
+
+VariableSlice(variable, index = Ellipsis)
+
+variable: a Variable instance.
+index: as taken by Variable.__getitem__.
+
+Nothing is read until evaluate is called, which returns what variable[index]
+would, with any operations applied.  Serialising one of these only serialises
+the Variable (so see Dataset for serialisation details), the index and the
+operations, so it's cheap to send to where the data is and evaluate there.
+
+Indexing a VariableSlice narrows it down further; if both indices contain only
+ints, slices and Ellipsis, this is combined into a single read.  The mean, sum,
+min and max methods (which take an axis, like numpy's) and multiplication (by
+anything numpy can multiply by, including another VariableSlice, which is
+evaluated at the same time) return a new VariableSlice, with the operation
+applied on evaluation.
+
+The easiest way to get one of these is through Variable.lazy.
+
+"""
+
+    def __init__ (self, variable, index = Ellipsis, ops = ()):
+        ranges = _index_ranges(index, variable.shape)
+        if ranges is None:
+            # can't combine further indexing: do it after reading
+            ranges = _index_ranges(Ellipsis, variable.shape)
+            ops = (('getitem', index),) + tuple(ops)
+        self._variable = variable
+        self._ranges = ranges
+        self._ops = tuple(ops)
+
+    def _with_op (self, op, arg):
+        s = object.__new__(self.__class__)
+        s.__setstate__((self._variable, self._ranges,
+                        self._ops + ((op, arg),)))
+        return s
+
+    # magic wrappers
+
+    def __str__ (self):
+        return '{0}({1}[{2}]{3})'.format(
+            self.__class__.__name__, self._variable._name,
+            _ranges_index(self._ranges),
+            ''.join('.{0}({1!r})'.format(*op) for op in self._ops)
+        )
+
+    def __getitem__ (self, index):
+        ranges = None
+        if not self._ops:
+            ranges = _compose_ranges(self._ranges, index)
+        if ranges is None:
+            return self._with_op('getitem', index)
+        s = object.__new__(self.__class__)
+        s.__setstate__((self._variable, ranges, ()))
+        return s
+
+    def __mul__ (self, other):
+        return self._with_op('mul', other)
+
+    __rmul__ = __mul__
+
+    def __array__ (self, *args):
+        return numpy.asarray(self.evaluate(), *args)
+
+    # serialisation
+
+    def __getstate__ (self):
+        return (self._variable, self._ranges, self._ops)
+
+    def __setstate__ (self, state):
+        self._variable, self._ranges, self._ops = state
+
+    # operations
+
+    def mean (self, axis = None):
+        return self._with_op('mean', axis)
+
+    def sum (self, axis = None):
+        return self._with_op('sum', axis)
+
+    def min (self, axis = None):
+        return self._with_op('min', axis)
+
+    def max (self, axis = None):
+        return self._with_op('max', axis)
+
+    def evaluate (self):
+        """Read the data and apply any operations to it."""
+        data = self._variable[_ranges_index(self._ranges)]
+        for op, arg in self._ops:
+            if op == 'getitem':
+                data = data[arg]
+            elif op == 'mul':
+                if isinstance(arg, VariableSlice):
+                    arg = arg.evaluate()
+                data = data * arg
+            else:
+                data = getattr(data, op)(arg)
+        return data
+
+
+class ParallelWriter (object):
+    """Write to a netCDF file from several processes at once.
+
+Takes the path of an existing netCDF file and, optionally, the path of a file
+to lock (defaults to the path with '.lock' appended).  Use
+Dataset.parallel_writer to get one for a file just created.
+
+Instances can be serialised and sent to any number of engines, which can then
+write to the file directly, eg.
+
+    d = Dataset(path, 'w')
+    # ...create dimensions and variables...
+    writer = d.parallel_writer()
+    dv.scatter('ranges', ranges)
+    dv.push({'writer': writer})
+    dv.execute('''
+var = writer.variable('tas')
+for t0, t1 in ranges:
+    var[t0:t1] = compute(t0, t1)
+''')
+
+The netCDF library doesn't support more than one process writing to a file at
+a time, so each write takes an exclusive lock on the lock file, opens the file
+in append mode, writes and closes it again.  Data doesn't go through the
+client, but writes are serialised, so this works best with writes that are
+large compared to opening the file.  To make several writes or other changes
+(such as to metadata) with one open, use a with statement, which holds the lock
+and the open file for its duration:
+
+    with writer as d:
+        # d is the open netCDF4.Dataset
+        d.variables['tas'][:10] = data
+        d.variables['tas'].history = 'written by an engine'
+
+Locks are POSIX record locks (fcntl.lockf), so they work across hosts on shared
+filesystems that support these (such as NFS with lockd).  Nothing else should
+have the file open while it's being written this way.
+
+When the lock is released, chunks of the file cached by this process (see
+set_block_cache) are dropped.  Caches in other processes, such as other
+engines, aren't: call clear_block_cache there before reading what was written.
+
+"""
+
+    def __init__ (self, path, lock_path = None):
+        self.path = path
+        self.lock_path = path + '.lock' if lock_path is None else lock_path
+        self._dataset = None
+        self._lock_file = None
+        self._depth = 0
+        # the file lock is per-process, so also lock between threads
+        self._thread_lock = threading.RLock()
+
+    def __getstate__ (self):
+        return (self.path, self.lock_path)
+
+    def __setstate__ (self, state):
+        self.__init__(*state)
+
+    def __enter__ (self):
+        self._thread_lock.acquire()
+        try:
+            if self._depth == 0:
+                f = open(self.lock_path, 'a')
+                try:
+                    fcntl.lockf(f, fcntl.LOCK_EX)
+                    self._dataset = netCDF4.Dataset(self.path, 'a')
+                except:
+                    f.close()
+                    raise
+                self._lock_file = f
+            self._depth += 1
+        except:
+            self._thread_lock.release()
+            raise
+        return self._dataset
+
+    def __exit__ (self, *args):
+        try:
+            self._depth -= 1
+            if self._depth == 0:
+                d = self._dataset
+                f = self._lock_file
+                self._dataset = self._lock_file = None
+                try:
+                    d.close()
+                finally:
+                    # closing the file releases the lock
+                    f.close()
+                    # anything in the file may have been written: drop it
+                    # from this process's cache (see set_block_cache)
+                    if _block_cache.max_size > 0:
+                        from nc_ipython.aggregation import resolve_files
+                        _block_cache.discard(resolve_files([self.path]))
+        finally:
+            self._thread_lock.release()
+
+    def _find (self, dataset, name, group = False):
+        # get a variable (or group) from a path like 'group/name'
+        parts = name.split('/') if name else []
+        if group:
+            parts.append(None)
+        for g in parts[:-1]:
+            dataset = dataset.groups[g]
+        return dataset if group else dataset.variables[parts[-1]]
+
+    def variable (self, name):
+        """Get a handle for writing to a variable.
+
+variable(name) -> handle
+
+name: as taken by write.
+
+handle: a serialisable object which can be indexed to read or assigned to by
+        index to write, like a Variable, through this writer.
+
+"""
+        return WriterVariable(self, name)
+
+    def write (self, name, index, data):
+        """Write data to part of a variable.
+
+write(name, index, data)
+
+name: the variable's name; for a variable in a group, the path to it, like
+      'group/subgroup/name'.
+index: the index to write to, as for netCDF4.Variable.__setitem__.
+data: the data to write.
+
+Equivalent to self.variable(name)[index] = data.
+
+"""
+        with self as d:
+            self._find(d, name)[index] = data
+
+    def read (self, name, index):
+        """Read data from part of a variable, while holding the lock.
+
+read(name, index) -> data
+
+Arguments are as for write.
+
+"""
+        with self as d:
+            return self._find(d, name)[index]
+
+    def setncatts (self, name, attrs, group = False):
+        """Set attributes of a variable or group.
+
+setncatts(name, attrs, group = False)
+
+name: as taken by write, or the path to a group if group is True (None for
+      the root group).
+attrs: dict of attributes to set.
+group: whether name is a group rather than a variable.
+
+"""
+        with self as d:
+            self._find(d, name, group).setncatts(attrs)
+
+
+class WriterVariable (object):
+    """A handle for writing to a variable through a ParallelWriter.
+
+Takes the ParallelWriter and the variable's name (as taken by
+ParallelWriter.write).  Use ParallelWriter.variable rather than creating one
+of these directly.
+
+Indexing reads (ParallelWriter.read) and assigning to an index writes
+(ParallelWriter.write).
+
+"""
+
+    def __init__ (self, writer, name):
+        self.writer = writer
+        self.name = name
+
+    def __getitem__ (self, index):
+        return self.writer.read(self.name, index)
+
+    def __setitem__ (self, index, val):
+        self.writer.write(self.name, index, val)
+
+
+# wrapper classes for the object dicts of a Dataset (see Dataset.__getattr__)
+_wrapper_classes = {
+    'cmptypes': CompoundType,
+    'dimensions': Dimension,
+    'groups': Group,
+    'vltypes': VLType,
+    'variables': Variable
+}
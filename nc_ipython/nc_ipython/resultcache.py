@@ -0,0 +1,232 @@
+"""A cache of computed results on disk, bounded in size.
+
+Results are stored by a key that should include everything the result depends
+on: typically the files read (with their modification times and sizes, as
+given by file_stamps), the arguments and the version of the code (as given by
+code_version).  When the cache grows beyond its maximum size, the least
+recently used results are removed.
+
+See the cached function, and set_cache_dir, set_cache_size, cache_stats and
+clear_cache.
+
+"""
+
+import os
+import sys
+import errno
+import threading
+import cPickle as pickle
+from hashlib import sha1
+from tempfile import mkstemp
+
+from nc_ipython.aggregation import resolve_files
+
+_cache_dir = os.path.join(os.path.expanduser('~'), '.nc_ipython', 'results')
+_max_size = 2 ** 30
+_stats = {'hits': 0, 'misses': 0, 'evictions': 0}
+# module name: code version
+_versions = {}
+_lock = threading.Lock()
+
+
+def set_cache_dir (path):
+    """Set the directory results are cached in.
+
+set_cache_dir(path)
+
+path: the directory; it's created if needed.  The default is
+      ~/.nc_ipython/results.
+
+"""
+    global _cache_dir
+    with _lock:
+        _cache_dir = path
+
+
+def set_cache_size (size):
+    """Set the maximum total size of cached results.
+
+set_cache_size(size)
+
+size: the size in bytes; the default is 1GiB.  Least recently used results are
+      removed to keep the cache within this size.
+
+"""
+    global _max_size
+    with _lock:
+        _max_size = size
+        _evict()
+
+
+def _entries ():
+    # [(last used, size, path)] for cached results, oldest first
+    entries = []
+    try:
+        names = os.listdir(_cache_dir)
+    except OSError:
+        return entries
+    for name in names:
+        if name.endswith('.pkl'):
+            path = os.path.join(_cache_dir, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                # removed by another process
+                continue
+            entries.append((st.st_mtime, st.st_size, path))
+    entries.sort()
+    return entries
+
+
+def _remove (path):
+    # remove a file, if it still exists
+    try:
+        os.remove(path)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+
+
+def _evict ():
+    # remove least recently used results until the cache is small enough
+    entries = _entries()
+    size = sum(s for t, s, path in entries)
+    for t, s, path in entries:
+        if size <= _max_size:
+            break
+        _remove(path)
+        size -= s
+        _stats['evictions'] += 1
+
+
+def cache_stats ():
+    """Get statistics for the result cache.
+
+cache_stats() -> stats
+
+stats: a dict with keys:
+    hits, misses: the number of calls to cached (in this process) that found a
+                  cached result, and that computed the result.
+    evictions: the number of results removed (by this process) to keep within
+               the maximum size.
+    entries, size: the number of results cached, and their total size in
+                   bytes.
+    max_size: the maximum size (see set_cache_size).
+    directory: the cache directory (see set_cache_dir).
+
+"""
+    with _lock:
+        stats = dict(_stats)
+        entries = _entries()
+        stats['entries'] = len(entries)
+        stats['size'] = sum(s for t, s, path in entries)
+        stats['max_size'] = _max_size
+        stats['directory'] = _cache_dir
+    return stats
+
+
+def clear_cache ():
+    """Remove all cached results.
+
+clear_cache()
+
+"""
+    with _lock:
+        for t, s, path in _entries():
+            _remove(path)
+
+
+def file_stamps (files):
+    """Identify a set of files by their contents' modification.
+
+file_stamps(files) -> stamps
+
+files: as taken by netCDF4.MFDataset.
+
+stamps: a tuple of (path, modification time, size) for each file, in order
+        (see nc_ipython.aggregation.resolve_files).
+
+"""
+    stamps = []
+    for path in resolve_files(files):
+        st = os.stat(path)
+        stamps.append((path, st.st_mtime, st.st_size))
+    return tuple(stamps)
+
+
+def code_version (module_name):
+    """Get a version identifier for the code in a module and nc_ipython.
+
+code_version(module_name) -> version
+
+module_name: the name of an imported module.
+
+version: a hash of the source of the module and of every module in the
+         nc_ipython package (such as ncserialisable and gridweights), so that
+         it changes whenever any of this code does.
+
+"""
+    with _lock:
+        if module_name not in _versions:
+            package_dir = os.path.dirname(os.path.abspath(__file__))
+            paths = [os.path.join(package_dir, name)
+                     for name in sorted(os.listdir(package_dir))
+                     if name.endswith('.py')]
+            path = sys.modules[module_name].__file__
+            if path.endswith(('.pyc', '.pyo')):
+                path = path[:-1]
+            h = sha1()
+            for path in [path] + paths:
+                with open(path, 'rb') as f:
+                    h.update(sha1(f.read()).digest())
+            _versions[module_name] = h.hexdigest()
+        return _versions[module_name]
+
+
+def cached (key, compute, refresh = False):
+    """Get a result from the cache, or compute and cache it.
+
+cached(key, compute, refresh = False) -> result
+
+key: a value with a repr that identifies the result, such as a tuple of
+     strings and numbers.
+compute: a function taking no arguments that computes the result, which must
+         be picklable.
+refresh: whether to compute the result even if it's cached, replacing the
+         cached result.
+
+"""
+    path = os.path.join(_cache_dir, sha1(repr(key)).hexdigest() + '.pkl')
+    if not refresh:
+        try:
+            with open(path, 'rb') as f:
+                stored_key, result = pickle.load(f)
+        except (IOError, EOFError, pickle.UnpicklingError, ValueError):
+            pass
+        else:
+            # check in case of hash collisions
+            if stored_key == repr(key):
+                with _lock:
+                    _stats['hits'] += 1
+                try:
+                    # mark as recently used
+                    os.utime(path, None)
+                except OSError:
+                    pass
+                return result
+
+    result = compute()
+    with _lock:
+        _stats['misses'] += 1
+        if not os.path.isdir(_cache_dir):
+            os.makedirs(_cache_dir)
+        fd, tmp = mkstemp(dir = _cache_dir)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                pickle.dump((repr(key), result), f, pickle.HIGHEST_PROTOCOL)
+            os.rename(tmp, path)
+        except:
+            os.remove(tmp)
+            raise
+        _evict()
+    return result
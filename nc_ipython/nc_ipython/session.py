@@ -0,0 +1,283 @@
+"""Engines set up once for repeated runs on the same data.
+
+Each parallel run sets up the engines it uses (importing modules, pushing the
+functions and data it needs, opening files) and cleans up afterwards.  When the
+same files are analysed again and again, a Session keeps all of this resident
+between runs: on the engines, and the open datasets and time indices on the
+client, so later runs only do what's changed.
+
+See the Session class, and the session argument to the run functions of the
+globalmean and seasonalmean modules.
+
+"""
+
+import marshal
+import cPickle as pickle
+from hashlib import sha1
+
+from IPython.parallel import Client, interactive
+from nc_ipython.ncserialisable import MFDataset
+from nc_ipython.resultcache import file_stamps
+
+
+def _signature (value):
+    # identify a value by its code or pickle, or None if it can't be
+    try:
+        if hasattr(value, 'func_code'):
+            data = marshal.dumps(value.func_code) + \
+                   pickle.dumps(value.func_defaults, pickle.HIGHEST_PROTOCOL)
+        else:
+            data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+    except (pickle.PicklingError, TypeError, ValueError):
+        return None
+    return sha1(data).hexdigest()
+
+
+@interactive
+def _release (names):
+    """Used by Session."""
+    # delete variables on an engine, closing any datasets in them (or in
+    # lists of them)
+    from nc_ipython.ncserialisable import Dataset
+    gl = globals()
+    datasets = set()
+    for name in names:
+        value = gl.pop(name, None)
+        values = value if isinstance(value, (list, tuple)) else [value]
+        for v in values:
+            if hasattr(v, 'group') and not isinstance(v, Dataset):
+                v = v.group()
+            if isinstance(v, Dataset):
+                datasets.add(v)
+    for d in datasets:
+        d.close()
+
+
+def _set_limits (max_memory, max_open, clear = False):
+    """Used by Session."""
+    from nc_ipython import ncserialisable
+    if clear:
+        ncserialisable.clear_block_cache()
+        ncserialisable.clear_pool()
+    ncserialisable.set_block_cache(max_memory)
+    if max_open is not None:
+        ncserialisable.set_pool_size(max_open)
+
+
+def _cache_stats ():
+    """Used by Session."""
+    from nc_ipython import ncserialisable
+    return ncserialisable.block_cache_stats()
+
+
+class Session (object):
+    """A set of engines that keeps data resident between runs.
+
+Session(engines = None, max_memory = 0, max_open = None, client = None)
+
+engines: a list of the engines to use; defaults to all available engines.
+max_memory: the most memory in bytes each engine may use to keep data read from
+            files, for later runs that read it again (see
+            ncserialisable.set_block_cache).  Data that doesn't fit is read
+            again when needed.
+max_open: the most files each engine keeps open when they're not in use (see
+          ncserialisable.set_pool_size); defaults to leaving this as it is.
+client: the IPython.parallel.Client to use; one is created if not given.
+
+Pass a session to a run function (such as seasonalmean.run) in place of
+engines.  Modules are then imported on the engines and functions pushed to
+them only once, and data the run pushes (such as variables and weights) is
+only pushed again if it's changed.  Pushed data stays on the engines, with
+the files it refers to open, until the session is closed.  On the client, the
+session keeps the datasets it opens (see dataset) and results it's asked to
+keep (see cached), reopening datasets if their files change.
+
+A session can be used as a DirectView by functions taking one (such as
+seasonalmean.get_mean_parallel), and then they don't clean up what they push.
+Engines shouldn't be used for other runs while the session is open, since
+these may remove what the session pushed.
+
+Close the session with close, or use it as a context manager.
+
+"""
+
+    def __init__ (self, engines = None, max_memory = 0, max_open = None,
+                  client = None):
+        self.client = Client() if client is None else client
+        self.dv = self.client[:]
+        if engines is not None:
+            self.dv.targets = engines
+        self.dv.block = True
+        self.max_memory = max_memory
+        self.max_open = max_open
+        # name: signature of the value pushed
+        self._pushed = {}
+        self._executed = set()
+        # files: file stamps, dataset
+        self._stamps = {}
+        self._datasets = {}
+        self._cached = {}
+        self.dv.apply_sync(_set_limits, max_memory, max_open)
+
+    def __enter__ (self):
+        return self
+
+    def __exit__ (self, *args):
+        self.close()
+
+    @property
+    def targets (self):
+        """The ids of the engines used."""
+        return self.dv.targets
+
+    def execute (self, code):
+        """Run code on the engines, unless it's already been run.
+
+execute(code)
+
+code: Python code to run, for setting up the engines, such as imports.
+
+"""
+        if code not in self._executed:
+            self.dv.execute(code)
+            self._executed.add(code)
+
+    def push (self, namespace):
+        """Set variables on the engines, unless they already have the values.
+
+push(namespace)
+
+namespace: a dict of values by variable name.  Values are compared with those
+           pushed before by their pickles (for functions, their code), and
+           only those that are different (or can't be compared) are pushed.
+           Datasets in values that are replaced are closed.
+
+"""
+        changed = {}
+        for name, value in namespace.iteritems():
+            signature = _signature(value)
+            if signature is None or self._pushed.get(name) != signature:
+                changed[name] = (value, signature)
+        if not changed:
+            return
+        old = [name for name in changed if name in self._pushed]
+        if old:
+            self.dv.apply_sync(_release, old)
+        self.dv.push(dict((name, value)
+                          for name, (value, signature) in changed.iteritems()))
+        for name, (value, signature) in changed.iteritems():
+            self._pushed[name] = signature
+
+    def map (self, f, *sequences, **kwargs):
+        """Call a function for each item of sequences, on the engines.
+
+Takes the same arguments as DirectView.map.
+
+"""
+        return self.dv.map(f, *sequences, **kwargs)
+
+    def apply_sync (self, f, *args, **kwargs):
+        """Call a function on every engine, returning the results.
+
+Takes the same arguments as DirectView.apply_sync.
+
+"""
+        return self.dv.apply_sync(f, *args, **kwargs)
+
+    def check_files (self, files):
+        """Remove everything kept by the session if files have changed.
+
+check_files(files) -> changed
+
+files: as taken by netCDF4.MFDataset.
+
+changed: whether the files have changed (by modification time or size, or
+         files being added or removed) since the last call with the same
+         files.  If so, everything kept by the session is removed (see
+         clear), since it may depend on them.
+
+Data kept on the engines isn't checked against the files it was read from, so
+run functions taking a session call this first.
+
+"""
+        key = repr(files)
+        stamps = file_stamps(files)
+        changed = self._stamps.get(key, stamps) != stamps
+        if changed:
+            self.clear()
+        self._stamps[key] = stamps
+        return changed
+
+    def dataset (self, files):
+        """Get an open dataset, kept open by the session.
+
+dataset(files) -> dataset
+
+files: as taken by netCDF4.MFDataset.
+
+dataset: an ncserialisable.MFDataset, the same one each time until the files
+         change (see check_files), when it's reopened.  Don't close it.
+
+"""
+        self.check_files(files)
+        key = repr(files)
+        if key not in self._datasets:
+            self._datasets[key] = MFDataset(files)
+        return self._datasets[key]
+
+    def cached (self, key, compute):
+        """Get a result kept by the session, or compute and keep it.
+
+cached(key, compute) -> result
+
+key: a hashable value identifying the result, which should include everything
+     the result depends on (such as nc_ipython.resultcache.file_stamps for the
+     files it's computed from).
+compute: a function taking no arguments that computes the result.
+
+"""
+        if key not in self._cached:
+            self._cached[key] = compute()
+        return self._cached[key]
+
+    def cache_stats (self):
+        """Get statistics for the data kept on each engine.
+
+cache_stats() -> stats
+
+stats: a list with a dict for each engine, as returned by
+       ncserialisable.block_cache_stats.
+
+"""
+        return self.dv.apply_sync(_cache_stats)
+
+    def clear (self):
+        """Remove everything kept by the session, but leave it open.
+
+clear()
+
+"""
+        # skip engines that died
+        targets = self.dv.targets
+        self.dv.targets = [t for t in targets if t in self.client.ids]
+        try:
+            if self._pushed:
+                self.dv.apply_sync(_release, list(self._pushed))
+            self.dv.apply_sync(_set_limits, self.max_memory, None, True)
+        finally:
+            self.dv.targets = targets
+            self._pushed.clear()
+            self._executed.clear()
+            for d in self._datasets.itervalues():
+                d.close()
+            self._datasets.clear()
+            self._cached.clear()
+
+    def close (self):
+        """Remove everything kept by the session, and stop keeping data.
+
+close()
+
+"""
+        self.max_memory = 0
+        self.clear()
@@ -67,20 +67,69 @@ kwargs: keyword arguments are also transferred.  That is,
 
     PreserveVars({'x': 5}, y = 10)
 
+Entering and exiting each take a single call to all the engines at once, and
+don't change dv.  To do these without waiting, use enter_async and exit_async
+instead of a with statement.
+
 """
 
     def __init__ (self, dv, data = {}, **kwargs):
         self.dv = dv
         data.update(kwargs)
         self.data = data
+        self._entered = None
 
     def __enter__ (self):
-        self.store_names = self.dv.apply(_enter, _base_store_name, self.data)
-
-    def __exit__ (self, *args):
-        dv = self.dv
-        targets = dv.targets
-        for target, store_name in zip(targets, self.store_names):
-            dv.targets = [target]
-            dv.apply(_exit, store_name)
-        dv.targets = targets
\ No newline at end of file
+        self.enter_async().get()
+        return self
+
+    def __exit__ (self, exc_type, *args):
+        try:
+            self.exit_async().get()
+        except Exception:
+            # don't hide an error from inside the with statement
+            if exc_type is None:
+                raise
+
+    def enter_async (self):
+        """Transfer the variables, without waiting for it to finish.
+
+enter_async() -> result
+
+result: an AsyncResult for the transfer.
+
+Call exit_async (which waits for this to finish) to restore the variables.
+
+"""
+        self._entered = self.dv.apply_async(_enter, _base_store_name,
+                                            self.data)
+        return self._entered
+
+    @property
+    def store_names (self):
+        """The names of the variables that the old values are stored in.
+
+This is a list with an item for each engine, in order; it waits for
+enter_async to finish if it hasn't.
+
+"""
+        names = self._entered.get()
+        return names if isinstance(names, list) else [names]
+
+    def exit_async (self):
+        """Restore the variables, without waiting for it to finish.
+
+exit_async() -> result
+
+result: an AsyncResult for the restore.
+
+"""
+        # the store name only depends on the names in data, so it's the same
+        # on every engine, and one call restores them all; the view only
+        # covers the engines entered
+        store_name = self.store_names[0]
+        engine_ids = self._entered.engine_id
+        if not isinstance(engine_ids, list):
+            engine_ids = [engine_ids]
+        view = self.dv.client.direct_view(engine_ids)
+        return view.apply_async(_exit, store_name)
@@ -1,12 +1,26 @@
 """A module to compute the seasonal mean over a variable in a dataset.
 
-See the run function.  time_bounds may also be useful.
+See the run function, and run_groups for other groupings of times (such as
+monthly means or climatologies).  time_bounds and season_indices may also be
+useful.
+
+Depends on IPython and nc_ipython (and so netCDF4).
 
 """
 
+from bisect import bisect_left, bisect_right
+from itertools import izip
+from contextlib import contextmanager, closing
+
 from IPython.parallel import Client, interactive
 import numpy
-from netCDF4 import MFDataset, num2date
+from nc_ipython.ncserialisable import MFDataset, iter_variable_blocks
+from nc_ipython.aggregation import aggregation_index
+from nc_ipython import resultcache
+from nc_ipython.calendars import year_month
+from nc_ipython.affinity import iter_affinity
+from nc_ipython.ncoutput import OutputFile
+from nc_ipython.session import Session
 
 
 def time_bounds (files, time_name = 'time'):
@@ -20,87 +34,872 @@ time_name: the name of the time variable; can actually be any one-dimensional
 
 Times are netCDF4.netcdftime.datetime objects.  If length is 0, times are None.
 
+This uses nc_ipython.aggregation, so only opens files that have changed since
+it was last called.
+
+"""
+    return aggregation_index(files, time_name).time_bounds()
+
+
+def season_indices (years, months, start_year, start_month, end_year,
+                    season_length = 3):
+    """Find the ranges of times making up seasons.
+
+season_indices(years, months, start_year, start_month, end_year,
+               season_length = 3) -> times
+
+years, months: arrays of the year and month of each time (see
+               nc_ipython.calendars.year_month).
+start_year, start_month, end_year, season_length: as taken by run.
+
+times: a list of (a, b) indices giving the seasons, as taken by
+       get_mean_serial.
+
+Seasons are found from the first time in start_year or later.  A season starts
+at the next time in start_month or a later month, and ends before the first
+time after that at least season_length months on in both year and month (so a
+season can start as soon as the last one ends).  A season that hasn't ended by
+the last time is left out, and no more seasons start after end_year.
+
+"""
+    years = numpy.asarray(years)
+    months = numpy.asarray(months)
+    begin = numpy.flatnonzero(years >= start_year)
+    if not len(begin):
+        return []
+    # times a season might start at: the first of these after the end of the
+    # last season starts the next one, unless it's after end_year
+    starts = numpy.flatnonzero((months >= start_month) | (years > end_year))
+    season_end_month = start_month + season_length
+    end_years = years[starts] + season_end_month // 12
+    season_end_month %= 12
+    # the end of a season starting at each of starts (or -1)
+    ends = numpy.empty(len(starts), int)
+    ends.fill(-1)
+    late = numpy.flatnonzero(months >= season_end_month)
+    if (numpy.diff(years) >= 0).all():
+        # years in order: the first time after the start that's late enough
+        # in the year, or the first in the end year if that's later
+        found = numpy.maximum(numpy.searchsorted(late, starts + 1),
+                              numpy.searchsorted(years[late], end_years))
+        ok = found < len(late)
+        ends[ok] = late[found[ok]]
+    else:
+        for y in numpy.unique(end_years):
+            candidates = late[years[late] >= y]
+            which = numpy.flatnonzero(end_years == y)
+            found = numpy.searchsorted(candidates, starts[which] + 1)
+            ok = found < len(candidates)
+            ends[which[ok]] = candidates[found[ok]]
+    # the position in starts of the next season's start after each season
+    following = numpy.searchsorted(starts, ends)
+    # follow the seasons from the first
+    starts_l = starts.tolist()
+    ends_l = ends.tolist()
+    following_l = following.tolist()
+    stop = (years[starts] > end_year).tolist()
+    times = []
+    i = numpy.searchsorted(starts, begin[0])
+    n = len(starts_l)
+    while i < n and not stop[i] and ends_l[i] >= 0:
+        times.append((starts_l[i], ends_l[i]))
+        i = following_l[i]
+    return times
+
+
+def season_partials (var, time_index, times, start, end, sumsq = False,
+                     tile = None, block_size = 1000, prefetch = 2):
+    """Compute partial seasonal aggregates over a range of times.
+
+season_partials(var, time_index, times, start, end, sumsq = False,
+                tile = None, block_size = 1000, prefetch = 2) -> partials
+
+var: ncserialisable variable to aggregate.
+time_index: the index of the time variable's dimension in var's dimensions.
+times: a list of (a, b) indices giving the seasons, as taken by
+       get_mean_serial.
+start, end: the range of times to aggregate over; only the parts of seasons
+            within this range are used.
+sumsq: whether to compute sums of squares as well.
+tile: only aggregate part of the other dimensions: a dict of slices of them by
+      dimension name (see spatial_tiles); dimensions that aren't given are
+      aggregated over entirely.
+block_size, prefetch: as taken by ncserialisable.Variable.iter_blocks; each
+                      season is read about block_size times at a time, so
+                      memory use doesn't depend on the length of the range
+                      or of seasons.
+
+partials: a list with an item for each season: None if the season is outside
+          the range, or else a dict with keys:
+    sum: the sum over time of the season's values in the range.
+    count: the number of those values that aren't missing.
+    sumsq: if sumsq is True, the sum over time of the squares of the values.
+Sums are float64.  Partials for different ranges can be combined with
+merge_partials and finished with finish_partials.
+
+"""
+    index = [slice(None) if tile is None else tile.get(d, slice(None))
+             for d in var.dimensions]
+    partials = []
+    for t0, t1 in times:
+        t0 = max(t0, start)
+        t1 = min(t1, end)
+        if t0 >= t1:
+            partials.append(None)
+            continue
+        partial = None
+        blocks = var.iter_blocks(block_size, time_index, t0, t1, index,
+                                 prefetch)
+        with closing(blocks):
+            for b0, b1, arr in blocks:
+                mask = numpy.ma.getmask(arr)
+                values = numpy.ma.getdata(arr)
+                if mask is numpy.ma.nomask:
+                    count = b1 - b0
+                else:
+                    values = numpy.where(mask, 0, values)
+                    count = (~mask).sum(time_index)
+                block = {'sum': values.sum(time_index, dtype = numpy.float64),
+                         'count': count}
+                if sumsq:
+                    values = values.astype(numpy.float64)
+                    block['sumsq'] = (values * values).sum(time_index)
+                if partial is None:
+                    partial = block
+                else:
+                    for key in block:
+                        partial[key] += block[key]
+        if numpy.ndim(partial['count']) == 0:
+            count = numpy.empty(partial['sum'].shape, int)
+            count.fill(partial['count'])
+            partial['count'] = count
+        partials.append(partial)
+    return partials
+
+
+def spatial_tiles (var, time_index, n_times, max_bytes):
+    """Split the dimensions other than time into tiles that fit in memory.
+
+spatial_tiles(var, time_index, n_times, max_bytes) -> tiles
+
+var: a list of ncserialisable variables to be read together.
+time_index: a corresponding list of the index of the time dimension in each.
+n_times: the number of times to be read at once.
+max_bytes: the most memory the variables' values for a tile may take.
+
+tiles: a list of dicts giving slices of the other dimensions by name, as taken
+       by season_partials, covering all of each variable.  There's a single
+       tile covering everything if it fits.
+
+Tiles are made smaller by halving the outermost dimension (so levels, then
+latitude, then longitude, for a usual layout) until they fit, keeping to whole
+storage chunks of the first variable while they're larger than a chunk.  If
+the tile size reaches 1 along every dimension, that's used even if it doesn't
+fit; read fewer times at once in that case.
+
+"""
+    # dimensions other than time, in order, with their sizes
+    dims = []
+    sizes = {}
+    for v, ti in zip(var, time_index):
+        for i, (d, n) in enumerate(zip(v.dimensions, v.shape)):
+            if i != ti and d not in sizes:
+                dims.append(d)
+                sizes[d] = n
+    chunks = var[0].chunk_shape()
+    chunks = {} if chunks is None else dict(zip(var[0].dimensions, chunks))
+
+    def size (tile):
+        # bytes for a tile
+        total = 0
+        for v, ti in zip(var, time_index):
+            n = n_times * v.dtype.itemsize
+            for i, d in enumerate(v.dimensions):
+                if i != ti:
+                    n *= tile[d]
+            total += n
+        return total
+
+    tile = dict(sizes)
+    for d in dims:
+        while size(tile) > max_bytes and tile[d] > 1:
+            n = tile[d] // 2
+            chunk = chunks.get(d, 1)
+            if n >= chunk:
+                n -= n % chunk
+            tile[d] = max(n, 1)
+
+    tiles = [{}]
+    for d in dims:
+        tiles = [dict(t.items() + [(d, slice(i, min(i + tile[d], sizes[d])))])
+                 for t in tiles for i in xrange(0, sizes[d], tile[d])]
+    return tiles
+
+
+def merge_partials (a, b):
+    """Combine partial seasonal aggregates for different times.
+
+merge_partials(a, b) -> partials
+
+a, b: lists of partials for the same seasons, as returned by season_partials.
+
+partials: the aggregates over the times of both a and b.
+
 """
-    with MFDataset(files) as d:
-        t = d.variables[time_name]
-        l = len(t)
-        if l == 0:
-            times = (None, None)
+    merged = []
+    for p, q in zip(a, b):
+        if p is None or q is None:
+            merged.append(q if p is None else p)
         else:
-            times = tuple(num2date((t[0], t[-1]), t.units, t.calendar))
-    return times + (l,)
+            merged.append(dict((k, p[k] + q[k]) for k in p if k in q))
+    return merged
+
+
+def finish_partials (partials, stats = ('mean',), dtype = None):
+    """Compute seasonal statistics from partial aggregates.
+
+finish_partials(partials, stats = ('mean',), dtype = None) -> results
+
+partials: as returned by season_partials or merge_partials, covering all of
+          each season.
+stats: the statistics to compute: any of 'mean', 'var' and 'std' (population
+       variance and standard deviation; these need partials with sumsq).
+dtype: the type of the results; defaults to float64.
+
+results: a dict with an array for each statistic, with time in seasons, as
+         returned by get_mean_serial for the mean.  Where there are no values
+         for a season, results are masked.
+
+"""
+    if not partials:
+        return dict((stat, numpy.array([])) for stat in stats)
+    count = numpy.array([p['count'] for p in partials])
+    total = numpy.array([p['sum'] for p in partials])
+    n = numpy.maximum(count, 1)
+    mean = total / n
+    results = {}
+    if 'var' in stats or 'std' in stats:
+        sumsq = numpy.array([p['sumsq'] for p in partials])
+        var = numpy.maximum(sumsq / n - mean * mean, 0)
+        results['var'] = var
+        results['std'] = numpy.sqrt(var)
+    results['mean'] = mean
+    for stat in stats:
+        result = results[stat]
+        if dtype is not None:
+            result = result.astype(dtype)
+        if (count == 0).any():
+            result = numpy.ma.masked_where(count == 0, result)
+        results[stat] = result
+    return dict((stat, results[stat]) for stat in stats)
 
 
 @interactive
-def _get_mean_worker (times):
+def _get_partials_worker (task):
     """Used by get_mean_parallel."""
-    results = []
-    index = [slice(None)] * time_index + [None, Ellipsis]
+    # var and time_index are lists, one item per variable
+    start, end, times, tile = task
+    return [season_partials(v, i, times, start, end, tile = tile)
+            for v, i in zip(var, time_index)]
+
+
+def iter_mean_serial (var, time_index, times, block_size = 1000,
+                      prefetch = 2):
+    """Compute the seasonal mean, a season at a time.
+
+iter_mean_serial(var, time_index, times, block_size = 1000,
+                 prefetch = 2) -> iterator
+
+Takes the same arguments as get_mean_serial, and yields the mean of var over
+each season, in order, with the time dimension removed.  If var is a list,
+each item is a corresponding list of means.
+
+"""
+    several = isinstance(var, (list, tuple))
+    if not several:
+        var = [var]
+        time_index = [time_index]
+    dtypes = [_mean_dtype(v) for v in var]
     for t0, t1 in times:
-        index[time_index] = slice(t0, t1)
-        arr = var[index]
-        results.append(arr.mean(time_index))
-    return numpy.array(results)
+        means = []
+        for v, i, dtype in zip(var, time_index, dtypes):
+            p = season_partials(v, i, [(t0, t1)], t0, t1,
+                                block_size = block_size, prefetch = prefetch)
+            means.append(finish_partials(p, dtype = dtype)['mean'][0])
+        yield means if several else means[0]
 
 
-def get_mean_serial (var, time_index, times):
+def get_mean_serial (var, time_index, times, block_size = 1000,
+                     prefetch = 2):
     """Compute the seasonal mean.
 
-get_mean_serial(var, time_index, times) -> results
+get_mean_serial(var, time_index, times, block_size = 1000,
+                prefetch = 2) -> results
 
-var: netCDF4 variable to average over.
-time_index: the index of the time variable's dimension in var's dimensions.
+var: ncserialisable variable to average over, or a list of variables to
+     average over together, reading each season of all of them before moving
+     on to the next.
+time_index: the index of the time variable's dimension in var's dimensions; if
+            var is a list, a corresponding list.
 times: a list of (a, b) indices indicating sets of times to take the mean over
        (var[a:b]).
+block_size, prefetch: as taken by season_partials.
+
+results: the var array with time now in seasons.  If var is a list, this is a
+         corresponding list of arrays.  Where a season has no values, results
+         are masked.
 
-results: the var array with time now in seasons.
+Means are sums and counts accumulated in float64 (see season_partials and
+finish_partials), converted to the type numpy.mean gives for var.  The
+parallel functions accumulate in the same way, but add up seasons split
+between chunks in a different order, so results agree with theirs to within
+float64 rounding before the conversion (usually exactly after it).
 
 """
-    results = []
-    index = [slice(None)] * time_index + [None, Ellipsis]
+    several = isinstance(var, (list, tuple))
+    if not several:
+        var = [var]
+        time_index = [time_index]
+    partials = [[] for v in var]
     for t0, t1 in times:
-        index[time_index] = slice(t0, t1)
-        arr = var[index]
-        results.append(arr.mean(time_index))
-    return numpy.array(results)
+        for v, i, p in zip(var, time_index, partials):
+            p.extend(season_partials(v, i, [(t0, t1)], t0, t1,
+                                     block_size = block_size,
+                                     prefetch = prefetch))
+    results = [finish_partials(p, dtype = _mean_dtype(v))['mean']
+               for v, p in zip(var, partials)]
+    return results if several else results[0]
 
 
-def get_mean_parallel (dv, var, time_index, times):
+def get_mean_parallel (dv, var, time_index, times, balanced = False,
+                       retries = 2, tasks_per_engine = 4, max_memory = None):
     """Compute the seasonal mean in parallel.
 
-get_mean_serial(dv, var, time_index, times) -> results
+get_mean_parallel(dv, var, time_index, times, balanced = False, retries = 2,
+                  tasks_per_engine = 4, max_memory = None) -> results
 
 dv: IPython DirectView to use.
-var: netCDF4 variable to average over.
-time_index: the index of the time variable's dimension in var's dimensions.
+var: ncserialisable variable to average over, or a list of variables to
+     average over together (see get_mean_serial).
+time_index: the index of the time variable's dimension in var's dimensions; if
+            var is a list, a corresponding list.
 times: a list of (a, b) indices indicating sets of times to take the mean over
        (var[a:b]).
+balanced: whether to split the range into more chunks than there are engines
+          and hand them to engines as they become free (using a
+          LoadBalancedView), rather than giving each engine one chunk.  This
+          is faster when some engines or files are slower than others.
+retries: for balanced runs, the number of times to retry a chunk on another
+         engine if it fails (including if its engine dies).
+tasks_per_engine: for balanced runs, the number of chunks to aim for per
+                  engine.
+max_memory: the most memory in bytes for an engine to use for the data it
+            reads at once, or 'auto' to use a quarter of the smallest amount
+            of memory available on the engines' hosts (shared between the
+            engines on each host).  If a block of times (see
+            season_partials) doesn't fit, chunks are split into tiles along
+            the other dimensions (see spatial_tiles).  The default is no
+            limit.
 
-results: the var array with time now in seasons.
+results: as returned by get_mean_serial.
+
+The range covered by the seasons is split into chunks of about the same size
+that suit the storage (as ncserialisable.Variable.partition gives for the
+first variable), regardless of where seasons start and end.  Each engine
+computes partial aggregates (see season_partials) for the parts of seasons in
+its chunks (and tiles), and these are combined for seasons split between
+chunks, and put together from tiles.
 
 """
-    # transfer var to the engines
-    dv.push({'var': var, 'time_index': time_index})
+    several = isinstance(var, (list, tuple))
+    if not several:
+        var = [var]
+        time_index = [time_index]
+    _push_variables(dv, var, time_index)
+    n_chunks = len(dv.targets)
+    if balanced:
+        n_chunks *= tasks_per_engine
+    chunks = _season_tasks(dv, var, time_index, times, n_chunks, max_memory)
+    tasks = [task for s0, task in chunks]
     # do the calculation
-    results = dv.parallel(block = True)(_get_mean_worker)(times)
-    # close datasets
-    dv.execute('var.group().close()')
-    # clean up variables
-    dv.execute('del var, time_index')
+    if balanced:
+        lview = dv.client.load_balanced_view(dv.targets)
+        lview.retries = retries
+        partials = lview.map(_get_partials_worker, tasks, block = True)
+    else:
+        partials = dv.map(_get_partials_worker, tasks, block = True)
+    seasons = list(_iter_combined(var, time_index, len(times), chunks,
+                                  partials))
+    results = [finish_partials([season[i] for season in seasons],
+                               dtype = _mean_dtype(v))['mean']
+               for i, v in enumerate(var)]
+    _clean_up(dv, 'season_partials')
+    return results if several else results[0]
+
+
+def iter_mean_parallel (dv, var, time_index, times, retries = 2,
+                        tasks_per_engine = 4, max_memory = None,
+                        max_pending = None):
+    """Compute the seasonal mean in parallel, a season at a time.
+
+iter_mean_parallel(dv, var, time_index, times, retries = 2,
+                   tasks_per_engine = 4, max_memory = None,
+                   max_pending = None) -> iterator
+
+Takes the same arguments as get_mean_parallel (runs are always balanced),
+plus:
+
+max_pending: the most chunks to have queued or running on engines at once;
+             defaults to twice the number of engines.
+
+This yields the mean over each season in order, as iter_mean_serial does.
+
+Chunks are handed to engines as they become free (see
+nc_ipython.affinity.iter_affinity), and a season's mean is yielded as soon as
+every chunk it overlaps is done.  No more than max_pending chunks are in
+progress at once, so memory use depends on the size of a chunk rather than
+the number of seasons.
+
+"""
+    several = isinstance(var, (list, tuple))
+    if not several:
+        var = [var]
+        time_index = [time_index]
+    if max_pending is None:
+        max_pending = 2 * len(dv.targets)
+    _push_variables(dv, var, time_index)
+    try:
+        chunks = _season_tasks(dv, var, time_index, times,
+                               len(dv.targets) * tasks_per_engine,
+                               max_memory)
+        # the tiles of a chunk read the same file, so share a key
+        partials = iter_affinity(dv.client, dv.targets, _get_partials_worker,
+                                 [(task,) for s0, task in chunks],
+                                 [task[:2] for s0, task in chunks],
+                                 max_pending, retries = retries)
+        dtypes = [_mean_dtype(v) for v in var]
+        for season in _iter_combined(var, time_index, len(times), chunks,
+                                     partials):
+            means = [finish_partials([p], dtype = dtype)['mean'][0]
+                     for p, dtype in zip(season, dtypes)]
+            yield means if several else means[0]
+    finally:
+        _clean_up(dv, 'season_partials')
+
+
+def _push_variables (dv, var, time_index):
+    # transfer var and what _get_partials_worker needs to the engines
+    dv.execute('import numpy')
+    dv.execute('from contextlib import closing')
+    dv.push({'var': list(var), 'time_index': list(time_index),
+             'season_partials': season_partials})
+
+
+def _season_tasks (dv, var, time_index, times, n_chunks, max_memory):
+    # split the range covered by seasons into n_chunks chunks that suit the
+    # storage, and these into tiles if they don't fit in max_memory, giving
+    # (first season, task for _get_partials_worker) for each, in order
+    starts = [t0 for t0, t1 in times]
+    ends = [t1 for t0, t1 in times]
+    chunks = []
+    if times:
+        ranges = var[0].partition(n_chunks, time_index[0], times[0][0],
+                                  times[-1][1])
+        tiles = [None]
+        if max_memory is not None:
+            if max_memory == 'auto':
+                max_memory = _engine_memory(dv)
+            # season_partials reads no more than a chunk, and about its
+            # block_size times, at once
+            n_times = min(max(c1 - c0 for c0, c1 in ranges), 1000)
+            tiles = spatial_tiles(var, time_index, n_times, max_memory)
+        for c0, c1 in ranges:
+            s0 = bisect_right(ends, c0)
+            s1 = bisect_left(starts, c1)
+            if s0 < s1:
+                chunks.extend((s0, (c0, c1, times[s0:s1], tile))
+                              for tile in tiles)
+    return chunks
+
+
+def _iter_combined (var, time_index, n_seasons, chunks, partials):
+    # combine partials for seasons split between chunks, putting tiles in
+    # place, and yield a list of each variable's partials for each season in
+    # order, as soon as no later chunk overlaps it; chunks are as returned by
+    # _season_tasks, and partials their results, in order
+    shapes = [v.shape[:ti] + v.shape[ti + 1:]
+              for v, ti in zip(var, time_index)]
+    dims = [v.dimensions[:ti] + v.dimensions[ti + 1:]
+            for v, ti in zip(var, time_index)]
+    combined = {}
+    done = 0
+    for (s0, (c0, c1, c_times, tile)), p in izip(chunks, partials):
+        # chunks are in order, so seasons before this one's are complete
+        for k in xrange(done, s0):
+            yield combined.pop(k)
+        done = max(done, s0)
+        for i in xrange(len(var)):
+            for k, partial in enumerate(p[i], s0):
+                if partial is None:
+                    continue
+                season = combined.setdefault(k, [None] * len(var))
+                if tile is None:
+                    season[i] = merge_partials([season[i]], [partial])[0]
+                    continue
+                if season[i] is None:
+                    season[i] = {'sum': numpy.zeros(shapes[i]),
+                                 'count': numpy.zeros(shapes[i], int)}
+                index = tuple(tile.get(d, slice(None)) for d in dims[i])
+                for key in ('sum', 'count'):
+                    season[i][key][index] += partial[key]
+    for k in xrange(done, n_seasons):
+        yield combined.pop(k)
+
+
+def _engine_memory (dv):
+    # memory for each engine to use for data: a quarter of the smallest
+    # amount available on a host, shared between its engines
+    hosts = dv.apply_sync(_host_memory)
+    engines = {}
+    for host, memory in hosts:
+        engines.setdefault(host, []).append(memory)
+    memory = [min(m) // len(m) for m in engines.itervalues()
+              if None not in m]
+    if not memory:
+        raise ValueError('can\'t find the memory available on engines')
+    return min(memory) // 4
+
+
+def _host_memory ():
+    """Used by get_mean_parallel."""
+    # (host name, available memory) for an engine
+    import os
+    import socket
+    try:
+        memory = os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (ValueError, OSError, AttributeError):
+        memory = None
+    return (socket.gethostname(), memory)
+
+
+def _mean_dtype (var):
+    # type of the mean of var's values, as numpy.mean gives
+    return numpy.mean(numpy.zeros(1, var.dtype)).dtype
+
+
+def _clean_up (dv, *names):
+    # close the datasets of var on engines, and delete var, time_index and the
+    # given names; engines that died are skipped, and a Session keeps them
+    if isinstance(dv, Session):
+        return
+    targets = dv.targets
+    dv.targets = [t for t in targets if t in dv.client.ids]
+    try:
+        # close datasets
+        dv.execute('for g in set(v.group() for v in var): g.close()')
+        # clean up variables
+        dv.execute('del ' + ', '.join(('var', 'time_index') + names))
+    finally:
+        dv.targets = targets
+
+
+_seasons = ('DJF', 'MAM', 'JJA', 'SON')
+_groupings = ('monthly', 'seasonal', 'annual', 'monthly_climatology',
+              'seasonal_climatology')
+
+
+def group_times (years, months, grouping, start_year = None,
+                 end_year = None):
+    """Assign times to groups.
+
+group_times(years, months, grouping, start_year = None, end_year = None)
+    -> (labels, keys)
+
+years, months: arrays of the year and month of each time (see
+               nc_ipython.calendars.year_month).
+grouping: one of:
+    'monthly': each month of each year; keys are (year, month).
+    'seasonal': each of the seasons DJF, MAM, JJA and SON of each year;
+                keys are (year, season), where December is in the next year's
+                DJF.
+    'annual': each year; keys are years.
+    'monthly_climatology': each month of the year, over all years; keys are
+                           months (1 to 12).
+    'seasonal_climatology': each season, over all years; keys are season
+                            names.
+    or a function taking years and months and returning an array of an integer
+    code for each time, where times with the same code are in the same group
+    and negative codes leave times out; keys are the codes.
+start_year, end_year: only include times from these years (inclusive), using
+                      the year the grouping gives (so the December before
+                      start_year is included in 'seasonal' groupings).
+
+labels: array of the index of each time's group in keys, or -1 for times in no
+        group.
+keys: a list identifying each group, in order of their codes (which is time
+      order for the groupings that aren't climatologies).
+
+"""
+    years = numpy.asarray(years)
+    months = numpy.asarray(months)
+    season = (months % 12) // 3
+    season_years = years + (months == 12)
+    if callable(grouping):
+        codes = numpy.asarray(grouping(years, months))
+        group_years = years
+    elif grouping == 'monthly':
+        codes = years * 12 + months - 1
+        group_years = years
+    elif grouping == 'seasonal':
+        codes = season_years * 4 + season
+        group_years = season_years
+    elif grouping == 'annual':
+        codes = years
+        group_years = years
+    elif grouping == 'monthly_climatology':
+        codes = months
+        group_years = years
+    elif grouping == 'seasonal_climatology':
+        codes = season
+        group_years = season_years
+    else:
+        raise ValueError('unknown grouping: {0!r}'.format(grouping))
+
+    use = numpy.ones(len(codes), bool)
+    if callable(grouping):
+        use &= codes >= 0
+    if start_year is not None:
+        use &= group_years >= start_year
+    if end_year is not None:
+        use &= group_years <= end_year
+    labels = numpy.empty(len(codes), int)
+    labels.fill(-1)
+    codes, labels[use] = numpy.unique(codes[use], return_inverse = True)
+    codes = codes.tolist()
+    if grouping == 'monthly':
+        keys = [(c // 12, c % 12 + 1) for c in codes]
+    elif grouping == 'seasonal':
+        keys = [(c // 4, _seasons[c % 4]) for c in codes]
+    elif grouping == 'seasonal_climatology':
+        keys = [_seasons[c] for c in codes]
+    else:
+        keys = codes
+    return (labels, keys)
+
+
+def block_group_partials (data, time_index, labels):
+    """Compute partial aggregates for groups of times in a block of data.
+
+block_group_partials(data, time_index, labels) -> partials
+
+data: a block of a variable's values (masked values are left out).
+time_index: the index of the time dimension in data.
+labels: a list of arrays giving the group of each time in data (or -1), one
+        for each grouping (see group_times).
+
+partials: a list with (groups, sums, counts) for each grouping, where groups
+          is an array of the labels of groups in the block, and sums and
+          counts are arrays of the sum over time of each group's values, and
+          the number of values that aren't missing.  The time dimension of
+          data is replaced with groups, and moved first.
+
+Every grouping is computed from the same data, and each run of consecutive
+times in the same group is summed at once.
+
+"""
+    mask = numpy.ma.getmask(data)
+    values = numpy.rollaxis(numpy.ma.getdata(data), time_index)
+    shape = values.shape[1:]
+    if mask is not numpy.ma.nomask:
+        valid = ~numpy.rollaxis(mask, time_index)
+        values = numpy.where(valid, values, 0)
+    partials = []
+    for l in labels:
+        l = numpy.asarray(l)
+        if not len(l):
+            partials.append((numpy.zeros(0, int),
+                             numpy.zeros((0,) + shape),
+                             numpy.zeros((0,) + shape, int)))
+            continue
+        # runs of times in the same group
+        run_starts = numpy.concatenate(([0],
+                                        numpy.flatnonzero(l[1:] != l[:-1]) +
+                                        1))
+        groups = l[run_starts]
+        keep = groups >= 0
+        groups = groups[keep]
+        sums = numpy.add.reduceat(values, run_starts, 0,
+                                  dtype = numpy.float64)[keep]
+        if mask is numpy.ma.nomask:
+            lengths = numpy.diff(numpy.append(run_starts, len(l)))[keep]
+            counts = numpy.empty(sums.shape, int)
+            counts[:] = lengths.reshape((-1,) + (1,) * len(shape))
+        else:
+            counts = numpy.add.reduceat(valid, run_starts, 0,
+                                        dtype = int)[keep]
+        partials.append(_combine_runs(groups, sums, counts))
+    return partials
+
+
+def _combine_runs (groups, sums, counts):
+    # combine partials for the same group, ordering by group
+    unique, inverse = numpy.unique(groups, return_inverse = True)
+    if (len(unique) < len(groups) or
+            (inverse != numpy.arange(len(groups))).any()):
+        s = numpy.zeros((len(unique),) + sums.shape[1:])
+        c = numpy.zeros((len(unique),) + counts.shape[1:], int)
+        numpy.add.at(s, inverse, sums)
+        numpy.add.at(c, inverse, counts)
+        sums, counts = s, c
+    return (unique, sums, counts)
+
+
+def group_partials (var, time_index, labels, start, end, block_size = 1000,
+                    prefetch = 2):
+    """Compute partial aggregates for groups of times in a range.
+
+group_partials(var, time_index, labels, start, end, block_size = 1000,
+               prefetch = 2) -> partials
+
+var: a list of ncserialisable variables to aggregate.
+time_index: a corresponding list of the index of the time dimension in each.
+labels: a list of arrays giving the group of each time in the range (or -1),
+        one for each grouping (see group_times).
+start, end: the range of times.
+block_size, prefetch: as taken by ncserialisable.Variable.iter_blocks.
+
+partials: a list with, for each variable, a list of partials as returned by
+          block_group_partials, for the whole range.
+
+"""
+    partials = [[[] for l in labels] for v in var]
+    blocks = iter_variable_blocks(var, block_size, time_index, start, end,
+                                  None, prefetch)
+    with closing(blocks):
+        for b0, b1, data in blocks:
+            block_labels = [l[b0 - start:b1 - start] for l in labels]
+            for d, i, p in zip(data, time_index, partials):
+                for all_p, block_p in zip(p, block_group_partials(
+                    d, i, block_labels
+                )):
+                    all_p.append(block_p)
+    return [[_combine_runs(*[numpy.concatenate(x) for x in zip(*p)])
+             if p else None
+             for p in var_p]
+            for var_p in partials]
+
+
+@interactive
+def _get_group_partials_worker (task):
+    """Used by get_group_means."""
+    start, end, labels, block_size = task
+    return group_partials(var, time_index, labels, start, end, block_size)
+
+
+def get_group_means (var, time_index, labels, n_groups, dv = None,
+                     balanced = False, retries = 2, tasks_per_engine = 4,
+                     block_size = 1000):
+    """Compute means over groups of times for several groupings at once.
+
+get_group_means(var, time_index, labels, n_groups, dv = None,
+                balanced = False, retries = 2, tasks_per_engine = 4,
+                block_size = 1000) -> results
+
+var: a list of ncserialisable variables to average.
+time_index: a corresponding list of the index of the time dimension in each.
+labels: a list of arrays giving the group of each time (or -1), one for each
+        grouping (see group_times).
+n_groups: a corresponding list of the number of groups in each grouping.
+dv: IPython DirectView to use to run in parallel, or None to run serially.
+balanced, retries, tasks_per_engine: for parallel runs, as taken by
+                                     get_mean_parallel.
+block_size: the number of times to read at once.
+
+results: a list with, for each variable, a list of arrays of means for each
+         grouping, with time replaced by groups and moved first (masked where
+         a group has no values).
+
+Only the range of times that are in some group is read, a block at a time, and
+each block is used for all the groupings.  Parallel runs split the range into
+chunks that suit the storage, as get_mean_parallel does.
+
+"""
+    used = numpy.zeros(len(labels[0]) if labels else 0, bool)
+    for l in labels:
+        used |= l >= 0
+    used = numpy.flatnonzero(used)
+    partials = []
+    if len(used):
+        start = used[0]
+        end = used[-1] + 1
+        if dv is None:
+            chunks = [(start, end)]
+            partials = [group_partials(var, time_index,
+                                       [l[start:end] for l in labels],
+                                       start, end, block_size)]
+        else:
+            dv.execute('import numpy')
+            dv.execute('from contextlib import closing')
+            dv.execute('from nc_ipython.ncserialisable import '
+                       'iter_variable_blocks')
+            dv.push({'var': list(var), 'time_index': list(time_index),
+                     'group_partials': group_partials,
+                     'block_group_partials': block_group_partials,
+                     '_combine_runs': _combine_runs})
+            n_chunks = len(dv.targets)
+            if balanced:
+                n_chunks *= tasks_per_engine
+            chunks = var[0].partition(n_chunks, time_index[0], start, end)
+            tasks = [(c0, c1, [l[c0:c1] for l in labels], block_size)
+                     for c0, c1 in chunks]
+            if balanced:
+                lview = dv.client.load_balanced_view(dv.targets)
+                lview.retries = retries
+                partials = lview.map(_get_group_partials_worker, tasks,
+                                     block = True)
+            else:
+                partials = dv.map(_get_group_partials_worker, tasks,
+                                  block = True)
+            _clean_up(dv, 'group_partials', 'block_group_partials',
+                      '_combine_runs')
+
+    # combine partials from each chunk
+    results = []
+    for i, v in enumerate(var):
+        shape = v.shape[:time_index[i]] + v.shape[time_index[i] + 1:]
+        v_results = []
+        for j, n in enumerate(n_groups):
+            sums = numpy.zeros((n,) + shape)
+            counts = numpy.zeros((n,) + shape, int)
+            for p in partials:
+                if p[i][j] is not None:
+                    groups, s, c = p[i][j]
+                    numpy.add.at(sums, groups, s)
+                    numpy.add.at(counts, groups, c)
+            means = (sums / numpy.maximum(counts, 1)).astype(_mean_dtype(v))
+            if (counts == 0).any():
+                means = numpy.ma.masked_where(counts == 0, means)
+            v_results.append(means)
+        results.append(v_results)
     return results
 
 
 def run (files, var_name, start_year, start_month, end_year, parallel = True,
          season_length = 3, engines = None, var_path = '/', time_path = '/',
-         time_name = 'time'):
+         time_name = 'time', balanced = False, retries = 2, cache = False,
+         refresh = False, max_memory = None, output = None, session = None):
     """Run a seasonal mean on a dataset.
 
 run(files, var_name, start_year, end_year, start_month, parallel = True,
     season_length = 3, engines = None, var_path = '/', time_path = '/',
-    time_name = 'time') -> results
+    time_name = 'time', balanced = False, retries = 2, cache = False,
+    refresh = False, max_memory = None, output = None, session = None)
+    -> results
 
 files: as taken by netCDF4.MFDataset.
-var_name: the name of the variable to compute the mean of.
+var_name: the name of the variable to compute the mean of, or a list of names
+          of variables to compute means of together.  Each season is read for
+          all of them at once, and the seasons are only worked out once.
 start_year: the year to start at (this year is included).
 end_year: the year to end at (this year is included).
 start_month: the month to start at (this month is included).
@@ -112,70 +911,218 @@ var_path, time_path: the path of the groups these variables are in within the
                      dataset.
 time_name: the name of the time variable.  This can actually be any
            one-dimensional variable - it doesn't need to represent time.
+balanced, retries, max_memory: for parallel runs, as taken by
+                               get_mean_parallel.
+cache: whether to use the result cache (see nc_ipython.resultcache): if a run
+       with the same files (with the same modification times and sizes),
+       variables and seasons was done before with the same version of this
+       module and nc_ipython, its result is returned without reading the
+       files.  Off by default.
+refresh: whether to compute the result even if it's cached, replacing the
+         cached result.
+output: the path of a netCDF file to write the results to instead of returning
+        them.  Each season is written as soon as it's done (see
+        iter_mean_serial, iter_mean_parallel and
+        nc_ipython.ncoutput.OutputFile), so only a season (or a chunk, for
+        parallel runs) is in memory at once.  The file has a variable named
+        after each variable, and a time coordinate at the middle of each
+        season, with bounds taken from the time variable's bounds if it has
+        them, or else running from the first time in the season to the first
+        time after it.  Metadata and other coordinates are copied from the
+        dataset.  With output, parallel runs are always balanced, and results
+        aren't cached.
+session: an nc_ipython.session.Session to use instead of engines.  The dataset,
+         its times, and what's pushed to the engines are kept by the session,
+         so later runs on the same files don't need to open them, read the
+         times or push the variables again.
 
-results: the array for the var variable, with time now in seasons.
+results: the array for the var variable, with time now in seasons.  If
+         var_name is a list, this is a dict of such arrays for each variable.
+         If output is given, this is output.
 
 """
+    if cache and output is None:
+        key = ('seasonalmean.run', resultcache.code_version(__name__),
+               resultcache.file_stamps(files),
+               var_name if isinstance(var_name, basestring)
+               else tuple(var_name),
+               start_year, start_month, end_year, season_length, var_path,
+               time_path, time_name)
+        compute = lambda: run(files, var_name, start_year, start_month,
+                              end_year, parallel, season_length, engines,
+                              var_path, time_path, time_name, balanced,
+                              retries, False, max_memory = max_memory,
+                              session = session)
+        return resultcache.cached(key, compute, refresh)
+
     if parallel:
-        c = Client()
-        dv = c[:]
-        if engines is not None:
-            dv.targets = engines
-        dv.block = True
-        dv.execute('import numpy')
-
-    with MFDataset(files) as d:
-        # find variables
-        vs = []
-        for path, v_name in ((time_path, time_name), (var_path, var_name)):
-            g = d
-            for g_name in path.strip('/').split('/'):
-                if g_name:
-                    g = g.groups[g_name]
-            vs.append(g.variables[v_name])
-        time, var = vs
-        time_index = var.dimensions.index(time.dimensions[0])
+        dv = _get_view(engines) if session is None else session
+
+    several = not isinstance(var_name, basestring)
+    var_names = list(var_name) if several else [var_name]
+    with _open(files, session) as d:
+        time, var, time_index = _find_variables(d, var_names, var_path,
+                                                time_path, time_name)
         # get time indices
-        times = time[:]
-        dates = num2date(times, time.units, time.calendar)
-        started = False
-        in_season = False
-        time_indices = []
-        n = len(times)
-        i = 0
-        while i < n:
-            t = times[i]
-            date = dates[i]
-            if started:
-                if in_season:
-                    if date.year >= season_end_year and \
-                       date.month >= season_end_month:
-                        # season ended; (i0, i) is used as [i0:i], skipping i,
-                        # as we want
-                        in_season = False
-                        time_indices.append((i0, i))
-                        # next season might start here: don't increment counter
-                        continue
-                elif date.year > end_year:
-                    # found end year (and no seasons are in progress)
-                    break
-                elif date.month >= start_month:
-                    # found new season
-                    in_season = True
-                    # get end year/month (might be longer than a year)
-                    season_end_month = start_month + season_length
-                    season_end_year = date.year + season_end_month / 12
-                    season_end_month %= 12
-                    i0 = i
-            elif date.year >= start_year:
-                # found start year
-                started = True
-                # first season might start here: don't increment counter
-                continue
-            i += 1
+        time_values, years, months = _times(files, time, time_path,
+                                            time_name, session)
+        time_indices = season_indices(years, months, start_year, start_month,
+                                      end_year, season_length)
 
+        if output is not None:
+            if parallel:
+                means = iter_mean_parallel(dv, var, time_index, time_indices,
+                                           retries, max_memory = max_memory)
+            else:
+                means = iter_mean_serial(var, time_index, time_indices)
+            _write_seasons(output, time, time_values, time_indices, var_names,
+                           var, means)
+            return output
         if parallel:
-            results = get_mean_parallel(dv, var, time_index, time_indices)
+            results = get_mean_parallel(dv, var, time_index, time_indices,
+                                        balanced, retries,
+                                        max_memory = max_memory)
         else:
             results = get_mean_serial(var, time_index, time_indices)
-    return results
\ No newline at end of file
+    return dict(zip(var_names, results)) if several else results[0]
+
+
+def run_groups (files, var_name, groupings, start_year = None,
+                end_year = None, parallel = True, engines = None,
+                var_path = '/', time_path = '/', time_name = 'time',
+                balanced = False, retries = 2, block_size = 1000,
+                session = None):
+    """Compute means over groups of times, for several groupings at once.
+
+run_groups(files, var_name, groupings, start_year = None, end_year = None,
+           parallel = True, engines = None, var_path = '/', time_path = '/',
+           time_name = 'time', balanced = False, retries = 2,
+           block_size = 1000, session = None) -> results
+
+files, var_name, parallel, engines, var_path, time_path, time_name, balanced,
+retries, session: as taken by run.
+groupings: a list of groupings as taken by group_times, such as
+           ['monthly', 'seasonal_climatology', 'annual'].
+start_year, end_year: the years to include (inclusive); the defaults are the
+                      first and last years.
+block_size: the number of times to read at once.
+
+results: a dict with (keys, means) for each grouping, where keys identify the
+         groups as returned by group_times, and means is the var array with
+         time replaced by groups (masked where a group has no values).  If
+         var_name is a list, this is a dict of such results for each variable.
+
+The data is read once, a block at a time, and each block is used for every
+group it's in, for all the groupings (see get_group_means).
+
+"""
+    if parallel:
+        dv = _get_view(engines) if session is None else session
+    else:
+        dv = None
+
+    several = not isinstance(var_name, basestring)
+    var_names = list(var_name) if several else [var_name]
+    with _open(files, session) as d:
+        time, var, time_index = _find_variables(d, var_names, var_path,
+                                                time_path, time_name)
+        time_values, years, months = _times(files, time, time_path,
+                                            time_name, session)
+        labels, keys = zip(*[group_times(years, months, g, start_year,
+                                         end_year)
+                             for g in groupings])
+        results = get_group_means(var, time_index, labels,
+                                  [len(k) for k in keys], dv, balanced,
+                                  retries, block_size = block_size)
+    results = [dict((g, (k, means))
+                    for g, k, means in zip(groupings, keys, var_results))
+               for var_results in results]
+    return dict(zip(var_names, results)) if several else results[0]
+
+
+def _season_times (time, values, times):
+    # time coordinate values (the middle of each season) and bounds for
+    # seasons; bounds are taken from time's bounds variable if it has one,
+    # and otherwise run from a season's first time to the next time after it
+    if not times:
+        return (numpy.zeros(0), numpy.zeros((0, 2)))
+    starts = numpy.array([t0 for t0, t1 in times], int)
+    ends = numpy.array([t1 for t0, t1 in times], int)
+    variables = time.group().variables
+    bounds_name = getattr(time, 'bounds', None)
+    if bounds_name is not None and bounds_name in variables:
+        source = variables[bounds_name][:]
+        bounds = numpy.column_stack((source[starts, 0], source[ends - 1, 1]))
+    else:
+        values = numpy.asarray(values, float)
+        # a time to end the last season at
+        step = values[-1] - values[-2] if len(values) > 1 else 0
+        values = numpy.append(values, values[-1] + step)
+        bounds = numpy.column_stack((values[starts], values[ends]))
+    bounds = bounds.astype(float)
+    return (bounds.mean(1), bounds)
+
+
+def _write_seasons (path, time, values, times, var_names, var, means):
+    # write seasonal means for a list of variables, as yielded by
+    # iter_mean_serial or iter_mean_parallel, to a netCDF file
+    time_values, bounds = _season_times(time, values, times)
+    with OutputFile(path, time, dtype = numpy.float64) as out:
+        for name, v in zip(var_names, var):
+            out.add_variable(name, v, dtype = _mean_dtype(v),
+                             attrs = {'cell_methods': '{0}: mean'.format(
+                                 time.dimensions[0])})
+        for k, season in enumerate(means):
+            out.append(time_values[k:k + 1],
+                       dict((name, numpy.ma.expand_dims(mean, 0))
+                            for name, mean in zip(var_names, season)),
+                       bounds[k:k + 1])
+
+
+@contextmanager
+def _open (files, session):
+    # the dataset for run and run_groups, kept open by session if given
+    if session is None:
+        with MFDataset(files) as d:
+            yield d
+    else:
+        yield session.dataset(files)
+
+
+def _times (files, time, time_path, time_name, session):
+    # (values, years, months) of the time variable for run and run_groups,
+    # kept by session if given
+    def compute ():
+        values = time[:]
+        return (values,) + year_month(values, time.units, time.calendar)
+    if session is None:
+        return compute()
+    return session.cached(('seasonalmean.times', repr(files), time_path,
+                           time_name), compute)
+
+
+def _get_view (engines):
+    # blocking DirectView for run and run_groups
+    c = Client()
+    dv = c[:]
+    if engines is not None:
+        dv.targets = engines
+    dv.block = True
+    dv.execute('import numpy')
+    return dv
+
+
+def _find_variables (d, var_names, var_path, time_path, time_name):
+    # (time, variables, time indices) for run and run_groups
+    vs = []
+    for path, v_name in ([(time_path, time_name)] +
+                         [(var_path, name) for name in var_names]):
+        g = d
+        for g_name in path.strip('/').split('/'):
+            if g_name:
+                g = g.groups[g_name]
+        vs.append(g.variables[v_name])
+    time = vs[0]
+    var = vs[1:]
+    time_index = [v.dimensions.index(time.dimensions[0]) for v in var]
+    return (time, var, time_index)
\ No newline at end of file